@@ -0,0 +1,420 @@
+import logging
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Any
+
+from tqdm import tqdm
+
+from spreads import SpreadJoiner
+
+log = logging.getLogger(__name__)
+
+
+class CbzWriter:
+    """
+    Writes pages straight into a CBZ as they finish, in page order.
+
+    Pages are stored uncompressed, as PNG, WebP and JPEG hardly deflate.
+    Each page has a slot, and whatever finishes out of order waits in a
+    reorder buffer until every slot before it is written. The archive is
+    built as path + ".part" and only renamed into place by close().
+    """
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = slots
+
+        self._zip = zipfile.ZipFile(f"{path}.part", "w", zipfile.ZIP_STORED)
+        self._buffer: dict[int, list[tuple[str, bytes]]] = {}
+        self._next = 0
+        self._flushing = False
+        self._lock = threading.Lock()
+
+    def put(self, slot: int, members: list[tuple[str, bytes]]):
+        """
+        Hand over the members of a slot, in the order they go in the
+        archive. A slot can be empty if its page went into another slot.
+        """
+        with self._lock:
+            self._buffer[slot] = members
+            if self._flushing:
+                # the thread writing will get to it
+                return
+            self._flushing = True
+
+        try:
+            while True:
+                with self._lock:
+                    ready = self._buffer.pop(self._next, None)
+                    if ready is None:
+                        self._flushing = False
+                        return
+                    self._next += 1
+
+                # written outside the lock, so other pages keep arriving
+                for name, data in ready:
+                    self._zip.writestr(name, data)
+        except BaseException:
+            with self._lock:
+                self._flushing = False
+            raise
+
+    def close(self, members: Iterable[tuple[str, bytes]] = ()):
+        """Add members after the pages, like metadata, and finish the archive."""
+        if self._next != self.slots:
+            raise RuntimeError(
+                f"{self.path}: only {self._next} of {self.slots} pages written"
+            )
+
+        for name, data in members:
+            self._zip.writestr(name, data, zipfile.ZIP_DEFLATED)
+        self._zip.close()
+        os.replace(f"{self.path}.part", self.path)
+
+    def abort(self):
+        self._zip.close()
+        if os.path.exists(f"{self.path}.part"):
+            os.remove(f"{self.path}.part")
+
+
+class PageArchive:
+    """
+    The pages of one gallery on their way into a CbzWriter.
+
+    Pages get slots in page order. The pages of a spread are held back until
+    all are in, then written together with their joined image, under the
+    names the folder layout gives them.
+    --------------------------
+    param: order -- list
+        Page indexes in page order
+    param: joiner -- SpreadJoiner
+        The spreads to join
+    param: join -- function
+        Takes the left and right page, each its decoded image if there is
+        one or else its data, returns the extension and data of the joined
+        image
+    """
+
+    def __init__(
+        self,
+        path: str,
+        order: list[str],
+        joiner: SpreadJoiner,
+        join: Callable[[Any, Any], tuple[str, bytes]],
+    ):
+        self.writer = CbzWriter(path, len(order))
+        self.joiner = joiner
+        self.join = join
+
+        self._slots = {idx: slot for slot, idx in enumerate(order)}
+
+    def add(self, idx: str, stem: str, ext: str, data: bytes, image: Any = None):
+        if idx not in self.joiner:
+            self.writer.put(self._slots[idx], [(f"{stem}.{ext}", data)])
+            return
+
+        halves = self.joiner.add(idx, (stem, ext, data, image))
+        if halves is None:
+            return
+
+        # spreads sharing a page are joined one after another, the shared
+        # page named after each of them as the folder layout does
+        stems = {key: half[0] for key, half in halves.items()}
+        members = []
+        for left, right in self.joiner.group(idx):
+            _, _, data_l, image_l = halves[left]
+            _, _, data_r, image_r = halves[right]
+            ext, joined = self.join(
+                data_l if image_l is None else image_l,
+                data_r if image_r is None else image_r,
+            )
+            members.append((f"{stems[left]}-{stems[right]}a.{ext}", joined))
+            stems[left] += "b."
+            stems[right] += "c."
+        for key, (_, ext, data, _) in halves.items():
+            members.append((f"{stems[key]}.{ext}", data))
+
+        first, *rest = sorted(self._slots[key] for key in halves)
+        self.writer.put(first, members)
+        for slot in rest:
+            self.writer.put(slot, [])
+
+    def close(self, members: Iterable[tuple[str, bytes]] = ()):
+        self.writer.close(members)
+
+    def abort(self):
+        self.writer.abort()
+
+
+# How members are compressed: images kept as they are and the rest deflated,
+# everything stored, everything deflated, or whichever is smaller per member
+ARCHIVE_POLICIES = ["auto", "store", "deflate", "smallest"]
+# Formats that are compressed already
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif", ".avif", ".jxl")
+
+_LOCAL_HEADER = struct.Struct("<4sHHHHHLLLHH")
+_CENTRAL_HEADER = struct.Struct("<4sHHHHHHLLLHHHHHLL")
+_END_RECORD = struct.Struct("<4sHHHHLLH")
+_ZIP_LIMIT = 0xFFFFFFFF
+_UTF8_NAME = 0x800
+
+
+def _dos_time(date_time: tuple) -> tuple[int, int]:
+    year, month, day, hour, minute, second = date_time
+    return (
+        hour << 11 | minute << 5 | second // 2,
+        (year - 1980) << 9 | month << 5 | day,
+    )
+
+
+class ArchiveBuilder:
+    """
+    Builds CBZs with their members compressed on all cores.
+
+    zlib lets go of the GIL, so members are read and compressed in a thread
+    pool and written out in order as they finish, a few ahead of the writer
+    at most. Archives are assembled without ZIP64, and the few that would
+    need it are built by zipfile instead.
+    --------------------------
+    param: policy -- str
+        One of ARCHIVE_POLICIES
+    param: workers -- int
+        Number of compressing threads, CPU count if None
+    """
+
+    def __init__(
+        self,
+        policy: str = "auto",
+        workers: int | None = None,
+        level: int = zlib.Z_DEFAULT_COMPRESSION,
+    ):
+        if policy not in ARCHIVE_POLICIES:
+            raise ValueError(f"Unknown compression policy {policy}")
+        self.policy = policy
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.workers)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def _compress(
+        self, info: zipfile.ZipInfo, read: Callable[[], bytes]
+    ) -> tuple[int, int, int, bytes]:
+        """
+        --------------------------
+        return: (compress_type, crc, file_size, payload) -- tuple
+        """
+        data = read()
+        crc = zlib.crc32(data)
+
+        if info.is_dir() or self.policy == "store":
+            return zipfile.ZIP_STORED, crc, len(data), data
+        if self.policy == "auto" and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+            return zipfile.ZIP_STORED, crc, len(data), data
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        payload = compressor.compress(data) + compressor.flush()
+        if self.policy == "smallest" and len(payload) >= len(data):
+            return zipfile.ZIP_STORED, crc, len(data), data
+        return zipfile.ZIP_DEFLATED, crc, len(data), payload
+
+    def build(
+        self, path: str, members: list[tuple[zipfile.ZipInfo, Callable[[], bytes]]]
+    ):
+        """Write members, given as info and a function reading the data, to path."""
+        try:
+            self._assemble(path, members)
+        except zipfile.LargeZipFile:
+            log.warning(f"{path} needs ZIP64, building it with zipfile")
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+                for info, read in members:
+                    zf.writestr(info, read())
+
+    def _assemble(
+        self, path: str, members: list[tuple[zipfile.ZipInfo, Callable[[], bytes]]]
+    ):
+        if len(members) >= 0xFFFF:
+            raise zipfile.LargeZipFile
+
+        central = []
+        pending = deque()
+        members_left = iter(members)
+
+        with open(path, "wb") as f:
+            while True:
+                # keep the pool busy while the writer waits on the next member
+                while len(pending) < 2 * self.workers:
+                    member = next(members_left, None)
+                    if member is None:
+                        break
+                    pending.append(
+                        (member[0], self.pool.submit(self._compress, *member))
+                    )
+                if not pending:
+                    break
+
+                info, future = pending.popleft()
+                compress_type, crc, file_size, payload = future.result()
+                offset = f.tell()
+                if max(file_size, len(payload), offset) >= _ZIP_LIMIT:
+                    for _, future in pending:
+                        future.cancel()
+                    raise zipfile.LargeZipFile
+
+                name = info.filename.encode("utf-8")
+                flags = _UTF8_NAME if not info.filename.isascii() else 0
+                version = 20 if compress_type == zipfile.ZIP_DEFLATED else 10
+                dos_time, dos_date = _dos_time(info.date_time)
+
+                f.write(
+                    _LOCAL_HEADER.pack(
+                        b"PK\003\004",
+                        version,
+                        flags,
+                        compress_type,
+                        dos_time,
+                        dos_date,
+                        crc,
+                        len(payload),
+                        file_size,
+                        len(name),
+                        0,
+                    )
+                )
+                f.write(name)
+                f.write(payload)
+                central.append(
+                    _CENTRAL_HEADER.pack(
+                        b"PK\001\002",
+                        info.create_system << 8 | 20,
+                        version,
+                        flags,
+                        compress_type,
+                        dos_time,
+                        dos_date,
+                        crc,
+                        len(payload),
+                        file_size,
+                        len(name),
+                        0,
+                        0,
+                        0,
+                        0,
+                        info.external_attr,
+                        offset,
+                    )
+                    + name
+                )
+
+            start = f.tell()
+            for entry in central:
+                f.write(entry)
+            end = f.tell()
+            if end >= _ZIP_LIMIT:
+                raise zipfile.LargeZipFile
+            f.write(
+                _END_RECORD.pack(
+                    b"PK\005\006",
+                    0,
+                    0,
+                    len(central),
+                    len(central),
+                    end - start,
+                    start,
+                    0,
+                )
+            )
+
+    def build_folder(self, folder: str) -> str:
+        """Archive the files under folder as folder + ".cbz"."""
+        members = []
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames.sort()
+            for name in sorted(dirnames) + sorted(filenames):
+                path = os.path.join(dirpath, name)
+                arcname = os.path.relpath(path, folder)
+                info = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+                members.append((info, lambda path=path: _read_file(path)))
+
+        cbz = f"{folder}.cbz"
+        self.build(f"{cbz}.part", members)
+        os.replace(f"{cbz}.part", cbz)
+        return cbz
+
+    def repack(self, path: str) -> int:
+        """
+        Rewrite a CBZ with the policy, keeping member names, order and times.
+        --------------------------
+        return: size -- int
+            Size of the new archive
+        """
+        with zipfile.ZipFile(path) as zf:
+            # zipfile serializes reads of the shared file, decompression
+            # still runs in parallel
+            members = [
+                (info, lambda info=info: zf.read(info)) for info in zf.infolist()
+            ]
+            self.build(f"{path}.part", members)
+        os.replace(f"{path}.part", path)
+        return os.path.getsize(path)
+
+
+def _read_file(path: str) -> bytes:
+    if os.path.isdir(path):
+        return b""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def repack_library(root: str, builder: ArchiveBuilder):
+    """Repack every CBZ under root and report the bytes saved."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        paths += [
+            os.path.join(dirpath, name)
+            for name in sorted(filenames)
+            if name.lower().endswith(".cbz")
+        ]
+    if not paths:
+        log.info(f"No cbz files under {root}")
+        return
+
+    log.info(f"Repacking {len(paths)} cbz files with {builder.policy} compression")
+    start = perf_counter()
+    before = after = 0
+    failed = 0
+    for path in tqdm(paths, desc="Repacking", unit="cbz"):
+        size = os.path.getsize(path)
+        try:
+            new_size = builder.repack(path)
+        except (zipfile.BadZipFile, zipfile.LargeZipFile, OSError) as e:
+            log.error(f"Could not repack {path}: {e}")
+            if os.path.exists(f"{path}.part"):
+                os.remove(f"{path}.part")
+            failed += 1
+            continue
+        log.debug(f"{path}: {size} -> {new_size} bytes")
+        before += size
+        after += new_size
+
+    seconds = perf_counter() - start
+    log.info(
+        "Repacked %d cbz files in %.1fs: %.1f MiB -> %.1f MiB, %.1f MiB saved (%.1f%%)",
+        len(paths) - failed,
+        seconds,
+        before / 2**20,
+        after / 2**20,
+        (before - after) / 2**20,
+        100 * (before - after) / before if before else 0.0,
+    )
+    if failed:
+        log.error(f"{failed} cbz files could not be repacked")
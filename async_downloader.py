@@ -0,0 +1,379 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, nullcontext
+from time import perf_counter
+from urllib.parse import urlsplit
+
+import curl_cffi
+from tqdm import tqdm
+
+from consts import HOST_CONNECTIONS
+from descramble import page_memory
+from descramble_downloader import DescrambleDownloader, Gallery, url_chapter_id
+from flow_control import is_congestion_status
+
+log = logging.getLogger(__name__)
+
+
+class HostLimiter:
+    """
+    One semaphore per host, bounding the requests in flight to each of them.
+    """
+
+    def __init__(
+        self,
+        default: int = HOST_CONNECTIONS,
+        limits: dict[str, int] | None = None,
+    ):
+        self.default = default
+        self.limits = limits or {}
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+
+    @asynccontextmanager
+    async def limit(self, url: str):
+        host = urlsplit(url).hostname or ""
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(
+                self.limits.get(host, self.default)
+            )
+
+        async with semaphore:
+            yield
+
+
+class AsyncDescrambleDownloader(DescrambleDownloader):
+    """
+    Downloader running every request of a gallery on one asyncio event loop.
+
+    All pages of a gallery are requested at once, bounded only by the per
+    host semaphores, while descrambling and disk work go to an executor.
+    Folders, archives and the done file are the same as with
+    DescrambleDownloader.
+    """
+
+    def __init__(
+        self,
+        *args,
+        host_connections: int = HOST_CONNECTIONS,
+        host_limits: dict[str, int] | None = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.host_limiter = HostLimiter(host_connections, host_limits)
+        self.async_session: curl_cffi.AsyncSession | None = None
+        self.async_proxy_sessions: dict[str, curl_cffi.AsyncSession] = {}
+
+        if self.stream:
+            log.warning("--stream is not supported by the asyncio engine, ignoring")
+
+    async def _get_async(self, request: dict, session=None):
+        if session is None:
+            session = self.async_session
+        assert session is not None
+
+        if self.rate_limiter is not None:
+            await asyncio.sleep(self.rate_limiter.delay(request["url"]))
+
+        async with self.host_limiter.limit(request["url"]):
+            if self.controller is None:
+                resp = await session.get(**request)
+            else:
+                start = perf_counter()
+                try:
+                    resp = await session.get(**request)
+                except curl_cffi.CurlError:
+                    self.controller.record(None, congested=True)
+                    raise
+                self.controller.record(
+                    perf_counter() - start, is_congestion_status(resp.status_code)
+                )
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.charge(request["url"], len(resp.content))
+
+        return resp
+
+    async def _get_cached_async(self, request: dict):
+        if self.http_cache is None:
+            return await self._get_async(request)
+
+        assert self.async_session is not None
+        session = self._cache_session(self.async_session.cookies)
+        cached, conditional = self.http_cache.lookup(request["url"], session)
+        if cached is not None:
+            return cached
+
+        request = {**request, "headers": {**request["headers"], **conditional}}
+        return self.http_cache.update(
+            request["url"], await self._get_async(request), session
+        )
+
+    async def _get_page_async(self, url: str):
+        if self.proxy_pool is None:
+            resp = await self._get_async(self._image_request(url))
+            resp.raise_for_status()
+            return resp
+
+        proxy = self.proxy_pool.choose()
+        start = perf_counter()
+        try:
+            resp = await self._get_async(
+                self._image_request(url),
+                self.async_proxy_sessions.get(proxy, self.async_session),
+            )
+        except curl_cffi.CurlError:
+            self.proxy_pool.record(proxy, 0, perf_counter() - start, failed=True)
+            raise
+
+        self.proxy_pool.record(
+            proxy, len(resp.content), perf_counter() - start, resp.status_code >= 400
+        )
+        resp.raise_for_status()
+        return resp
+
+    def _page_async_slot(self):
+        if self.controller is None:
+            return nullcontext()
+        return self.controller.async_slot()
+
+    def _page_async_memory(self):
+        if self.memory_budget is None:
+            return nullcontext()
+        return self.memory_budget.async_reserve()
+
+    async def _fetch_tracked_async(self, url: str) -> Gallery | None:
+        self._url_started(url)
+        gallery = await self._fetch_gallery_async(url)
+        if gallery is None:
+            self._url_failed(url, self._fetch_error(url))
+        return gallery
+
+    async def _fetch_gallery_async(self, url: str) -> Gallery | None:
+        log.info(url)
+
+        assert self.async_session is not None
+
+        if self.api_first:
+            resp = await self._get_cached_async(self._api_request(url_chapter_id(url)))
+            chapter_id = self._api_chapter_id(resp)
+            if chapter_id is not None:
+                if self._redirects_to_done(url, chapter_id):
+                    return None
+
+                log.info(f'Downloading "{chapter_id}" manga.')
+
+                metadata = OrderedDict()
+                if self.save_metadata != "basic":
+                    page = await self._get_cached_async(self._gallery_page_request(url))
+                    metadata = await asyncio.to_thread(
+                        self._parse_page_metadata, page.content, page.encoding
+                    )
+
+                return await asyncio.to_thread(
+                    self._prepare_gallery,
+                    url,
+                    chapter_id,
+                    metadata,
+                    resp,
+                    self.async_session.cookies,
+                )
+
+            log.debug("Reader API needs the gallery pages first")
+
+        resp = await self._get_cached_async(self._gallery_page_request(url))
+
+        parsed = await asyncio.to_thread(
+            self._parse_gallery_page, url, resp.content, resp.encoding
+        )
+        if parsed is None:
+            return None
+        chapter_id, metadata = parsed
+
+        log.info(f'Downloading "{chapter_id}" manga.')
+
+        resp = await self._get_cached_async(self._read_page_request(url))
+
+        if not self._has_access(url, resp.text):
+            return None
+
+        resp = await self._get_cached_async(self._api_request(chapter_id))
+
+        return await asyncio.to_thread(
+            self._prepare_gallery,
+            url,
+            chapter_id,
+            metadata,
+            resp,
+            self.async_session.cookies,
+        )
+
+    async def _download_page_async(
+        self,
+        executor: ThreadPoolExecutor,
+        gallery: Gallery,
+        idx: str,
+        page: dict,
+    ) -> bool:
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            try:
+                async with self._page_async_memory() as reservation:
+                    async with self._page_async_slot():
+                        content = (await self._get_page_async(page["image"])).content
+                    if reservation is not None:
+                        assert self.memory_budget is not None
+                        await self.memory_budget.async_charge(
+                            reservation, page_memory(content)
+                        )
+
+                    processed = await loop.run_in_executor(
+                        executor,
+                        self._process_page,
+                        page["image"],
+                        content,
+                        gallery.keys.get(idx),
+                        idx in gallery.joiner,
+                    )
+                    await loop.run_in_executor(
+                        executor,
+                        self._save_page,
+                        gallery,
+                        idx,
+                        page,
+                        content,
+                        processed,
+                    )
+                return True
+            except (curl_cffi.CurlError, OSError) as e:
+                delay = self._retry_page(idx, attempt, e)
+                if delay is None:
+                    return False
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _download_pages_async(
+        self, executor: ThreadPoolExecutor, gallery: Gallery
+    ) -> bool:
+        pages = await asyncio.to_thread(self._resume_pages, gallery)
+        total = len(gallery.api_data["pages"])
+        failed = 0
+        if self.direct_cbz:
+            await asyncio.to_thread(self._start_archive, gallery)
+
+        with tqdm(
+            total=total,
+            initial=total - len(pages),
+            desc="Working...",
+            unit="page",
+            leave=False,
+            position=0,
+        ) as pbar:
+            tasks = [
+                asyncio.create_task(
+                    self._download_page_async(executor, gallery, idx, page)
+                )
+                for idx, page in pages.items()
+            ]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    if await task:
+                        pbar.update()
+                        if self.memory_budget is not None:
+                            pbar.set_postfix_str(self.memory_budget.progress())
+                    else:
+                        failed += 1
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        if failed:
+            log.error(
+                f"{failed} pages of {gallery.url} failed, "
+                "run again to download only the missing pages"
+            )
+            self._abort_archive(gallery)
+
+        return not failed
+
+    async def _load_all_async(self):
+        urls_processed = 0
+
+        max_clients = max(
+            [self.host_limiter.default, *self.host_limiter.limits.values()]
+        )
+        self.async_session = curl_cffi.AsyncSession(
+            cookies=self.cookie_jar,
+            proxy=self.proxy,
+            impersonate="chrome",
+            max_clients=max_clients,
+        )
+        self.async_session.headers.update(self.session.headers)
+        for proxy in self.proxy_sessions:
+            session = self.async_proxy_sessions[proxy] = curl_cffi.AsyncSession(
+                cookies=self.cookie_jar,
+                proxy=proxy,
+                impersonate="chrome",
+                max_clients=max_clients,
+            )
+            session.headers.update(self.session.headers)
+
+        started: set[str] = set()
+        finishing: asyncio.Task | None = None
+        pending: deque[asyncio.Task] = deque()
+        urls = iter(self.urls)
+
+        def prefetch():
+            while len(pending) <= self.lookahead:
+                url = next(urls, None)
+                if url is None:
+                    return
+                pending.append(asyncio.create_task(self._fetch_tracked_async(url)))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+                prefetch()
+                while pending:
+                    gallery = await pending.popleft()
+                    prefetch()
+
+                    urls_processed += 1
+                    if gallery is None or self._is_started(gallery, started):
+                        continue
+
+                    if not await self._download_pages_async(executor, gallery):
+                        self._url_failed(gallery.url, "pages missing")
+                        continue
+                    started.add(gallery.chapter_url)
+
+                    if finishing is not None:
+                        await finishing
+                    finishing = asyncio.create_task(
+                        asyncio.to_thread(self._finish_gallery, gallery)
+                    )
+
+                    log.debug("Finished parsing page")
+                    await asyncio.sleep(self._gallery_delay())
+
+                if finishing is not None:
+                    await finishing
+        finally:
+            for task in pending:
+                task.cancel()
+            await self.async_session.close()
+            for session in self.async_proxy_sessions.values():
+                await session.close()
+
+        return urls_processed
+
+    def load_all(self):
+        log.debug("Starting asyncio downloader function")
+
+        self._make_root_dirs()
+
+        urls_processed = asyncio.run(self._load_all_async())
+
+        self._finish_run(urls_processed)
@@ -0,0 +1,80 @@
+"""
+Benchmark for parsing gallery pages with the bs4 and lxml backends.
+
+Runs both backends over the gallery pages in benchmarks/fixtures, checks they
+find the same reader link and metadata as fixtures/expected.json, and times
+a full parse (reader link and metadata) of each page. The fixtures follow the
+layout of the live gallery pages: a regular gallery, one that cannot be read,
+a free one, one with irregular whitespace and markup in its rows, and a large
+one with many tags and related galleries.
+
+    python benchmarks/bench_gallery_parser.py [number]
+    python benchmarks/bench_gallery_parser.py --update-expected
+"""
+
+import glob
+import json
+import os
+import sys
+from timeit import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures")
+sys.path.insert(0, ROOT)
+
+from gallery_parser import GALLERY_PARSERS  # noqa: E402
+
+
+def parse(backend: str, content: bytes) -> list:
+    parser = GALLERY_PARSERS[backend]
+    doc = parser.parse(content, "utf-8")
+    return [parser.reader_href(doc), parser.page_metadata(doc)]
+
+
+def main():
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.html"))):
+        with open(path, "rb") as f:
+            pages[os.path.basename(path)] = f.read()
+
+    expected_file = os.path.join(FIXTURES, "expected.json")
+    if "--update-expected" in sys.argv:
+        expected = {name: parse("bs4", content) for name, content in pages.items()}
+        with open(expected_file, "w", encoding="utf-8") as f:
+            json.dump(expected, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+        return
+
+    with open(expected_file, encoding="utf-8") as f:
+        expected = json.load(f)
+
+    for name, content in pages.items():
+        for backend in GALLERY_PARSERS:
+            # compared as json to check the key order too
+            assert json.dumps(parse(backend, content)) == json.dumps(
+                expected[name]
+            ), f"{backend} differs on {name}"
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    total = {backend: 0.0 for backend in GALLERY_PARSERS}
+
+    print(f"{len(pages)} pages, {number} runs each")
+    for name, content in pages.items():
+        line = f"{name:>28} {len(content) // 1024:5d} KiB"
+        for backend in GALLERY_PARSERS:
+            seconds = timeit(lambda: parse(backend, content), number=number)
+            total[backend] += seconds
+            line += f"  {backend}: {1000 * seconds / number:7.3f} ms"
+        print(line)
+
+    print(
+        f"{'total':>38}"
+        + "".join(
+            f"  {backend}: {1000 * seconds / number:7.3f} ms"
+            for backend, seconds in total.items()
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
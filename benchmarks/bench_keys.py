@@ -0,0 +1,67 @@
+"""
+Micro-benchmark for decrypting and parsing page keys.
+
+Compares the old byte-by-byte XOR with decode_xor_cipher, and parsing every
+page key up front with LazyKeys, on synthetic key data for a large gallery.
+
+    python benchmarks/bench_keys.py [pages]
+"""
+
+import json
+import os
+import random
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import LazyKeys, calculate_decryption_key, decode_xor_cipher  # noqa: E402
+
+
+def decode_xor_cipher_bytewise(key: bytes, content: bytes) -> bytes:
+    key_length = len(key)
+    decoded = bytearray(len(content))
+    for i in range(len(content)):
+        decoded[i] = content[i] ^ key[i % key_length]
+    return bytes(decoded)
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rng = random.Random(0)
+
+    data = json.dumps(
+        {
+            str(page): [rng.randrange(2**31) for _ in range(rng.randint(8, 16))]
+            for page in range(1, pages + 1)
+        }
+    )
+    key = calculate_decryption_key("%064x" % rng.getrandbits(256), "0" * 64)
+    encrypted = decode_xor_cipher(key, data.encode("utf-8"))
+
+    assert decode_xor_cipher_bytewise(key.encode("utf-8"), encrypted) == (
+        data.encode("utf-8")
+    )
+    assert dict(LazyKeys(data)) == json.loads(data)
+
+    number = 20
+    results = {
+        "xor bytewise": timeit(
+            lambda: decode_xor_cipher_bytewise(key.encode("utf-8"), encrypted),
+            number=number,
+        ),
+        "xor bulk": timeit(lambda: decode_xor_cipher(key, encrypted), number=number),
+        "json.loads all keys": timeit(lambda: json.loads(data), number=number),
+        "LazyKeys first page": timeit(lambda: LazyKeys(data)["1"], number=number),
+        "LazyKeys all pages": timeit(
+            lambda: [page for page in LazyKeys(data).values()], number=number
+        ),
+    }
+
+    print(f"{pages} pages, {len(encrypted)} bytes of key data")
+    for name, seconds in results.items():
+        print(f"{name:>20}: {1000 * seconds / number:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
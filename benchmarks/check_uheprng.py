@@ -0,0 +1,76 @@
+"""
+Golden-vector check and benchmark of the tile permutation generator.
+
+Checks that seeded_randoms, the UHEPRNG class and the tile shuffle built on
+them give exactly the draws and permutations of the reference JS generator,
+stored in fixtures/uheprng_vectors.json, then times seeded_randoms against
+UHEPRNG. The vectors are regenerated from hknk/engine/uheprng.mjs with node:
+
+    python benchmarks/check_uheprng.py [number]
+    python benchmarks/check_uheprng.py --update-expected
+"""
+
+import json
+import os
+import subprocess
+import sys
+from timeit import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.join(ROOT, "benchmarks")
+VECTORS = os.path.join(BENCHMARKS, "fixtures", "uheprng_vectors.json")
+sys.path.insert(0, ROOT)
+
+from uheprng import UHEPRNG, seeded_randoms  # noqa: E402
+from utils import _randomize  # noqa: E402
+
+
+def reference_randoms(seed, count: int) -> list[float]:
+    prng = UHEPRNG()
+    prng.seed(seed)
+    return [prng.random() for _ in range(count)]
+
+
+def main():
+    if "--update-expected" in sys.argv:
+        vectors = subprocess.run(
+            ["node", os.path.join(BENCHMARKS, "uheprng_vectors.mjs")],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        with open(VECTORS, "w", encoding="utf-8") as f:
+            f.write(vectors)
+        return
+
+    with open(VECTORS, encoding="utf-8") as f:
+        vectors = json.load(f)
+
+    for vector in vectors:
+        seed, draws = vector["seed"], vector["draws"]
+        length = len(vector["permutation"])
+        assert seeded_randoms(seed, len(draws)) == draws, f"seeded_randoms, {seed!r}"
+        assert reference_randoms(seed, len(draws)) == draws, f"UHEPRNG, {seed!r}"
+        assert (
+            _randomize(list(range(length)), seed) == vector["permutation"]
+        ), f"permutation, {seed!r}"
+    print(f"{len(vectors)} seeds match the reference generator")
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    count = len(vectors[0]["permutation"])
+    for name, generate in (
+        ("UHEPRNG", reference_randoms),
+        ("seeded_randoms", seeded_randoms),
+    ):
+        seconds = timeit(
+            lambda: [generate(vector["seed"], count) for vector in vectors],
+            number=number,
+        )
+        print(
+            f"{name:>15}: {1e6 * seconds / number / len(vectors):8.1f} us "
+            f"per seed, {count} draws"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+// Golden vectors of the reference generator for check_uheprng.py:
+//     node benchmarks/uheprng_vectors.mjs > benchmarks/fixtures/uheprng_vectors.json
+import uheprng from '../hknk/engine/uheprng.mjs';
+
+const SEEDS = [
+  0, 1, 7, 42, 12345, 31337, 65535, 987654321, 2147483647, 4294967295,
+  'abc', ' padded seed ', '0a10f3bd42587ad70fc96886d8e5e7b3',
+];
+const DRAWS = 100;
+const LENGTH = 200;
+
+const vectors = [];
+for (const seed of SEEDS) {
+  const prng = uheprng.create(seed);
+  const draws = [];
+  for (let i = 0; i < DRAWS; i++) draws.push(prng.random());
+
+  // the shuffle the reader applies to page tiles
+  const permutation = [...Array(LENGTH).keys()];
+  const shuffler = uheprng.create(seed);
+  for (let i = LENGTH; i;) {
+    const j = Math.floor(shuffler.random() * i--);
+    [permutation[i], permutation[j]] = [permutation[j], permutation[i]];
+  }
+  vectors.push({ seed, draws, permutation });
+}
+console.log(JSON.stringify(vectors, null, 1));
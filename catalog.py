@@ -0,0 +1,326 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zipfile
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from time import perf_counter, time
+
+import lxml.etree
+from tqdm import tqdm
+
+from archive import IMAGE_EXTENSIONS
+from utils import url_chapter_id
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class CatalogEntry:
+    """A gallery in the library, as a cbz or an image folder."""
+
+    path: str
+    url: str | None
+    chapter_id: str | None
+    title: str
+    artists: list[str]
+    tags: list[str]
+    pages: int
+    size: int
+
+
+def _as_list(value) -> list[str]:
+    # info.json keeps lists of one as the item alone
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(item) for item in value]
+    return [str(value)]
+
+
+def _split(text: str | None) -> list[str]:
+    return [item.strip() for item in (text or "").split(",") if item.strip()]
+
+
+def entry_from_metadata(
+    path: str, metadata: Mapping, pages: int, size: int
+) -> CatalogEntry:
+    """Entry of a gallery from its metadata, as the downloader or info.json has it."""
+    url = metadata.get("URL")
+    return CatalogEntry(
+        path=os.path.abspath(path),
+        url=url,
+        chapter_id=url_chapter_id(url) if url else None,
+        title=metadata.get("Title") or _gallery_name(path),
+        artists=_as_list(metadata.get("Artist")),
+        tags=_as_list(metadata.get("Tags")),
+        pages=int(metadata.get("Pages") or pages),
+        size=size,
+    )
+
+
+def entry_from_comicinfo(path: str, xml: bytes, pages: int, size: int) -> CatalogEntry:
+    doc = lxml.etree.fromstring(xml)
+    url = doc.findtext("Web")
+    return CatalogEntry(
+        path=os.path.abspath(path),
+        url=url,
+        chapter_id=url_chapter_id(url) if url else None,
+        title=doc.findtext("Title") or _gallery_name(path),
+        artists=_split(doc.findtext("Penciller")),
+        tags=_split(doc.findtext("Genre")),
+        pages=int(doc.findtext("PageCount") or pages),
+        size=size,
+    )
+
+
+def _gallery_name(path: str) -> str:
+    name = os.path.basename(path.rstrip(os.sep))
+    return name[:-4] if name.lower().endswith(".cbz") else name
+
+
+def _is_image(name: str) -> bool:
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def read_entry(path: str) -> CatalogEntry:
+    """
+    Entry of a gallery on disk, from its info.json, else its ComicInfo.xml,
+    else just its name and files.
+    """
+    if os.path.isdir(path):
+        names = os.listdir(path)
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in names)
+
+        def read(name: str) -> bytes:
+            with open(os.path.join(path, name), "rb") as f:
+                return f.read()
+
+        return _read_entry(path, names, read, size)
+
+    with zipfile.ZipFile(path) as zf:
+        return _read_entry(path, zf.namelist(), zf.read, os.path.getsize(path))
+
+
+def _read_entry(path: str, names: list[str], read, size: int) -> CatalogEntry:
+    # spread halves are kept next to their joined page, count it once
+    pages = sum(1 for name in names if _is_image(name) and ".." not in name)
+    if "info.json" in names:
+        return entry_from_metadata(path, json.loads(read("info.json")), pages, size)
+    if "ComicInfo.xml" in names:
+        return entry_from_comicinfo(path, read("ComicInfo.xml"), pages, size)
+    return entry_from_metadata(path, {}, pages, size)
+
+
+def library_paths(root: str) -> list[str]:
+    """The cbz files and image folders of the galleries under root."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        cbzs = [name for name in sorted(filenames) if name.lower().endswith(".cbz")]
+        # a folder next to its cbz is still being archived
+        archived = {name[:-4] for name in cbzs}
+        dirnames[:] = sorted(name for name in dirnames if name not in archived)
+        if dirpath != root and any(
+            _is_image(name) or name == "info.json" for name in filenames
+        ):
+            paths.append(dirpath)
+        paths += [os.path.join(dirpath, name) for name in cbzs]
+    return paths
+
+
+class Catalog:
+    """
+    sqlite index of the galleries in the library.
+
+    The downloader adds every gallery it finishes, with its url, chapter id,
+    title, artists, tags, page count, size and path, so what is in the
+    library can be looked up without walking it and opening every archive.
+    rebuild() indexes an existing library from the metadata in its archives.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        log.debug(f"Opening catalog {path}")
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS galleries ("
+            "path TEXT PRIMARY KEY, "
+            "url TEXT, "
+            "chapter_id TEXT, "
+            "title TEXT NOT NULL, "
+            "artists TEXT NOT NULL, "
+            "tags TEXT NOT NULL, "
+            "pages INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "added REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS galleries_chapter ON galleries (chapter_id);"
+        )
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @staticmethod
+    def _row(entry: CatalogEntry, added: float) -> tuple:
+        return (
+            entry.path,
+            entry.url,
+            entry.chapter_id,
+            entry.title,
+            json.dumps(entry.artists, ensure_ascii=False),
+            json.dumps(entry.tags, ensure_ascii=False),
+            entry.pages,
+            entry.size,
+            added,
+        )
+
+    @staticmethod
+    def _entry(row: tuple) -> CatalogEntry:
+        path, url, chapter_id, title, artists, tags, pages, size = row
+        return CatalogEntry(
+            path,
+            url,
+            chapter_id,
+            title,
+            json.loads(artists),
+            json.loads(tags),
+            pages,
+            size,
+        )
+
+    def add(self, entry: CatalogEntry):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO galleries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self._row(entry, time()),
+            )
+            self._db.commit()
+
+    def find_chapter(self, chapter_id: str) -> list[CatalogEntry]:
+        return self.query(chapter_id=chapter_id)
+
+    def query(
+        self,
+        title: str | None = None,
+        artist: str | None = None,
+        tag: str | None = None,
+        chapter_id: str | None = None,
+    ) -> list[CatalogEntry]:
+        """
+        Galleries matching all of the given filters, in title order.
+        --------------------------
+        param: title -- str
+            Part of the title, in any case
+        param: artist, tag -- str
+            One of the artists or tags, in any case
+        """
+        where = []
+        params = []
+        if title is not None:
+            where.append("title LIKE ?")
+            params.append(f"%{title}%")
+        for column, value in (("artists", artist), ("tags", tag)):
+            if value is not None:
+                where.append(
+                    f"EXISTS (SELECT 1 FROM json_each({column}) "
+                    "WHERE value = ? COLLATE NOCASE)"
+                )
+                params.append(value)
+        if chapter_id is not None:
+            where.append("chapter_id = ?")
+            params.append(chapter_id)
+
+        sql = (
+            "SELECT path, url, chapter_id, title, artists, tags, pages, size "
+            "FROM galleries"
+        )
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self._lock:
+            rows = self._db.execute(f"{sql} ORDER BY title, path", params).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def duplicates(self) -> list[list[CatalogEntry]]:
+        """Galleries of the same chapter kept more than once."""
+        with self._lock:
+            chapter_ids = [
+                chapter_id
+                for (chapter_id,) in self._db.execute(
+                    "SELECT chapter_id FROM galleries WHERE chapter_id IS NOT NULL "
+                    "GROUP BY chapter_id HAVING COUNT(*) > 1 ORDER BY chapter_id"
+                )
+            ]
+        return [self.find_chapter(chapter_id) for chapter_id in chapter_ids]
+
+    def report(self, top: int = 10) -> dict:
+        """Totals of the library and its most common artists and tags."""
+        with self._lock:
+            galleries, pages, size = self._db.execute(
+                "SELECT COUNT(*), TOTAL(pages), TOTAL(size) FROM galleries"
+            ).fetchone()
+            report = {"galleries": galleries, "pages": int(pages), "size": int(size)}
+            for column in ("artists", "tags"):
+                report[column] = self._db.execute(
+                    f"SELECT value, COUNT(*) AS n FROM galleries, json_each({column}) "
+                    "GROUP BY value ORDER BY n DESC, value LIMIT ?",
+                    (top,),
+                ).fetchall()
+        return report
+
+    def rebuild(self, root: str, workers: int | None = None) -> int:
+        """
+        Replace the catalog with the galleries under root, reading their
+        metadata in parallel. Returns how many were indexed.
+        """
+        paths = library_paths(root)
+        log.info(f"Indexing {len(paths)} galleries under {root}")
+        start = perf_counter()
+
+        def read(path: str) -> CatalogEntry | None:
+            try:
+                return read_entry(path)
+            except (zipfile.BadZipFile, lxml.etree.XMLSyntaxError, ValueError) as e:
+                log.error(f"Could not index {path}: {e}")
+            except OSError as e:
+                log.error(f"Could not read {path}: {e}")
+            return None
+
+        now = time()
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            entries = [
+                entry
+                for entry in tqdm(
+                    pool.map(read, paths), total=len(paths), desc="Indexing"
+                )
+                if entry is not None
+            ]
+
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM galleries")
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO galleries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [self._row(entry, now) for entry in entries],
+                )
+
+        log.info(
+            "Indexed %d galleries in %.1fs, %d could not be read",
+            len(entries),
+            perf_counter() - start,
+            len(paths) - len(entries),
+        )
+        return len(entries)
+
+    def log(self):
+        report = self.report(0)
+        log.info(
+            "Catalog: %d galleries, %d pages, %.1f MiB",
+            report["galleries"],
+            report["pages"],
+            report["size"] / 2**20,
+        )
@@ -3,6 +3,8 @@ BASE_URL = "https://www.fakku.net"
 API_URL = "https://reader.fakku.net"
 LOGIN_URL = f"{BASE_URL}/login/"
 OPTIMIZE = True
+# Seconds pingo/ect get per page before it is kept unoptimized
+OPTIMIZE_TIMEOUT = 60
 
 # File with manga urls
 URLS_FILE = "urls.txt"
@@ -20,6 +22,57 @@ TIMEOUT = 10
 WAIT = 0.1
 # Should a cbz archive file be created
 ZIP = False
+# Descrambler used for keyed pages, numpy, pillow or jpeg
+DESCRAMBLE_ENGINE = "numpy"
+# Number of tile permutations kept in memory
+PERMUTATION_CACHE_SIZE = 4096
+# sqlite file for persisting tile permutations between runs, None to disable
+PERMUTATION_CACHE_FILE = None
+# Number of threads downloading pages of a gallery
+DOWNLOAD_WORKERS = 5
+# Format descrambled pages are saved in, png or webp
+PAGE_FORMAT = "png"
+# zlib level 0-9 for png or method 0-6 for webp, None for png optimize
+COMPRESS_LEVEL = None
+# Stream pages to disk instead of reading whole responses into memory
+STREAM = False
+# Requests in flight per host with the asyncio engine
+HOST_CONNECTIONS = 64
+# Galleries whose metadata and keys are fetched ahead of the one downloading
+LOOKAHEAD = 2
+# Adapt page concurrency and the wait between galleries to server pushback
+ADAPTIVE = True
+# Upper bound of the adaptive page concurrency
+MAX_DOWNLOAD_WORKERS = 32
+# Times a failed page is retried before its gallery is left for the next run
+RETRIES = 3
+# Seconds before the first retry of a page, doubled for every further one
+RETRY_BACKOFF = 2.0
+# sqlite file caching gallery HTML and reader API responses, None to disable
+HTTP_CACHE_FILE = None
+# Seconds a cached response is used without revalidating it
+HTTP_CACHE_TTL = 300
+# MiB of cached responses kept before the least recently used are evicted
+HTTP_CACHE_SIZE = 64
+# Parser for gallery pages, lxml (XPath) or bs4 (BeautifulSoup)
+HTML_PARSER = "lxml"
+# Ask the reader API for a gallery first and skip the /read page, and the
+# gallery page too with basic metadata
+API_FIRST = False
+# Write pages straight into the cbz as they finish (needs zip, no optimize)
+DIRECT_CBZ = False
+# How cbz members are compressed, auto, store, deflate or smallest
+ARCHIVE_COMPRESSION = "auto"
+# Folder of the content-addressed page store shared by galleries, None to disable
+PAGE_STORE = None
+# MiB of responses, images and encoded pages held in flight before new page
+# fetches wait, 0 to disable
+MEMORY_BUDGET = 1024
+# sqlite file queueing urls and tracking their state instead of the urls and
+# done files, None to use the files
+STATE_DB = None
+# sqlite catalog of the galleries in the library, None to disable
+CATALOG = None
 
 LANG_MAP = {
     "English": "en",
@@ -0,0 +1,510 @@
+import logging
+import os
+import tempfile
+from io import BytesIO
+from math import ceil
+from time import perf_counter
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image, JpegImagePlugin
+
+try:
+    import jpeglib
+except ImportError:
+    jpeglib = None
+
+JPEG_DCT_AVAILABLE = jpeglib is not None
+
+from encoders import encode_page, write_page
+from page_store import detach_file, image_digest, link_file, store_path
+from utils import permutation_cache, randomize, shuffle_array
+
+log = logging.getLogger(__name__)
+
+TILE_SIZE = 128
+
+
+def get_tile_layout(width: int, height: int) -> tuple[bool, int, int, int]:
+    """
+    Compute the tile grid of a scrambled page.
+    --------------------------
+    param: width -- int
+        Width of the descrambled page
+    param: height -- int
+        Height of the descrambled page
+    return: (is_horizontal, offset, width_pieces, height_pieces) -- tuple
+        The last tile row (horizontal pages) or column (vertical pages) is
+        shifted back by offset pixels so it ends flush with the page edge.
+    """
+    is_horizontal = width > height
+    if is_horizontal:
+        smaller_edge = height
+    else:
+        smaller_edge = width
+
+    offset = TILE_SIZE * ceil(smaller_edge / TILE_SIZE) - smaller_edge
+    width_pieces = ceil(width / TILE_SIZE)
+    height_pieces = ceil(height / TILE_SIZE)
+
+    return is_horizontal, offset, width_pieces, height_pieces
+
+
+def descramble_pillow(
+    image: Image.Image, width: int, height: int, piece_order: list[int]
+) -> Image.Image:
+    """
+    Reference descrambler, pastes one tile at a time.
+    """
+    is_horizontal, offset, width_pieces, height_pieces = get_tile_layout(width, height)
+
+    out = Image.new("RGB", (width, height))
+
+    for index, value in enumerate(piece_order):
+        sx_piece = value % width_pieces
+        sy_piece = (value - sx_piece) // width_pieces
+        dx_piece = index % width_pieces
+        dy_piece = (index - dx_piece) // width_pieces
+
+        if is_horizontal:
+            last_piece = dy_piece == height_pieces - 1
+        else:
+            last_piece = dx_piece == width_pieces - 1
+
+        dx = dx_piece * TILE_SIZE
+        dy = dy_piece * TILE_SIZE
+
+        if last_piece:
+            dx -= 0 if is_horizontal else offset
+            dy -= offset if is_horizontal else 0
+
+        sx = sx_piece * TILE_SIZE
+        sy = sy_piece * TILE_SIZE
+
+        out.paste(image.crop((sx, sy, sx + TILE_SIZE, sy + TILE_SIZE)), (dx, dy))
+
+    return out
+
+
+def _permute_tiles(
+    src: np.ndarray,
+    tile_height: int,
+    tile_width: int,
+    width_pieces: int,
+    height_pieces: int,
+    piece_order: list[int],
+) -> np.ndarray:
+    """
+    Rearrange the tiles of a (rows, columns, ...) array so that tile index
+    of the result is tile piece_order[index] of src, in a single gather.
+    """
+    trailing = src.shape[2:]
+    tiles = src.reshape(height_pieces, tile_height, width_pieces, tile_width, *trailing)
+    tiles = tiles.swapaxes(1, 2).reshape(-1, tile_height, tile_width, *trailing)
+
+    grid = tiles[np.asarray(piece_order, dtype=np.intp)]
+    grid = grid.reshape(height_pieces, width_pieces, tile_height, tile_width, *trailing)
+    return grid.swapaxes(1, 2).reshape(
+        height_pieces * tile_height, width_pieces * tile_width, *trailing
+    )
+
+
+def descramble_numpy(
+    image: Image.Image, width: int, height: int, piece_order: list[int]
+) -> Image.Image:
+    """
+    Vectorized descrambler, bit-identical to descramble_pillow.
+
+    The whole tile permutation is applied as a single gather over a
+    (tiles, 128, 128, 3) view of the page, then the shifted last row or
+    column is written over the grid in one slice assignment.
+    """
+    is_horizontal, _, width_pieces, height_pieces = get_tile_layout(width, height)
+    grid_width = width_pieces * TILE_SIZE
+    grid_height = height_pieces * TILE_SIZE
+
+    # Cropping pads out-of-bounds tiles with zeros in the source mode before
+    # conversion, the same as cropping each tile individually would.
+    src = np.asarray(image.crop((0, 0, grid_width, grid_height)).convert("RGB"))
+    grid = _permute_tiles(
+        src, TILE_SIZE, TILE_SIZE, width_pieces, height_pieces, piece_order
+    )
+
+    out = grid[:height, :width].copy()
+
+    # The last row/column is pasted after every other tile and overlaps the
+    # one before it, so it wins wherever the two meet.
+    if is_horizontal:
+        start = height - TILE_SIZE
+        skip = max(0, -start)
+        last = grid[(height_pieces - 1) * TILE_SIZE + skip :, :width]
+        out[max(0, start) : height, :] = last
+    else:
+        start = width - TILE_SIZE
+        skip = max(0, -start)
+        last = grid[:height, (width_pieces - 1) * TILE_SIZE + skip :]
+        out[:, max(0, start) : width] = last
+
+    return Image.fromarray(out, "RGB")
+
+
+# Pillow's subsampling setting for (horizontal, vertical) luma sampling factors
+JPEG_SUBSAMPLING = {(1, 1): 0, (2, 1): 1, (2, 2): 2}
+
+
+def _read_dct(content: bytes | str):
+    # only reached once descramble_jpeg checked jpeglib is there
+    assert jpeglib is not None
+    if isinstance(content, str):
+        jpeg = jpeglib.read_dct(content)
+        jpeg.load()
+        return jpeg
+
+    fd, path = tempfile.mkstemp(suffix=".jpg")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        jpeg = jpeglib.read_dct(path)
+        jpeg.load()
+    finally:
+        os.remove(path)
+    return jpeg
+
+
+def descramble_jpeg(
+    content: bytes | str,
+    image: Image.Image,
+    width: int,
+    height: int,
+    piece_order: list[int],
+) -> bytes | None:
+    """
+    Descramble a JPEG page by moving its quantized DCT blocks, the way
+    jpegtran's lossless crop and drop do, so nothing is decoded or re-encoded.
+
+    128px tiles always line up with the MCU grid. The shifted last row or
+    column only does when the page size is a multiple of the MCU; otherwise
+    just the MCUs it touches are descrambled in pixels and re-encoded with
+    the page's own quantization tables.
+    --------------------------
+    param: content -- bytes or string
+        The scrambled JPEG, or the path of a file holding it
+    return: bytes or None
+        The descrambled JPEG, or None if the page can't be handled this way
+        and needs the pixel descrambler.
+    """
+    if (
+        jpeglib is None
+        or not isinstance(image, JpegImagePlugin.JpegImageFile)
+        or image.format != "JPEG"
+        or image.mode not in ("L", "RGB")
+    ):
+        return None
+
+    jpeg = _read_dct(content)
+    components = [jpeg.Y]
+    if jpeg.has_chrominance:
+        components += [jpeg.Cb, jpeg.Cr]
+
+    # samp_factor rows are (vertical, horizontal) per component
+    sampling = [(int(f[1]), int(f[0])) for f in jpeg.samp_factor]
+    h_max = max(f[0] for f in sampling)
+    v_max = max(f[1] for f in sampling)
+    mcu_width = 8 * h_max
+    mcu_height = 8 * v_max
+    if TILE_SIZE % mcu_width or TILE_SIZE % mcu_height:
+        return None
+
+    is_horizontal, _, width_pieces, height_pieces = get_tile_layout(width, height)
+    if is_horizontal:
+        edge, mcu_edge = height, mcu_height
+    else:
+        edge, mcu_edge = width, mcu_width
+    start = edge - TILE_SIZE
+    if start < 0:
+        return None
+
+    band = None
+    band_start = start - start % mcu_edge
+    if band_start != start:
+        subsampling = JPEG_SUBSAMPLING.get((h_max, v_max))
+        if subsampling is None:
+            return None
+
+        log.debug(f"Edge is not MCU aligned, re-encoding from {band_start}px")
+        pixels = descramble_numpy(image, width, height, piece_order)
+        if is_horizontal:
+            pixels = pixels.crop((0, band_start, width, height))
+        else:
+            pixels = pixels.crop((band_start, 0, width, height))
+        if image.mode == "L":
+            pixels = pixels.convert("L")
+
+        band_bytes = BytesIO()
+        pixels.save(
+            band_bytes,
+            "JPEG",
+            qtables=image.quantization,
+            subsampling=subsampling,
+        )
+        band = _read_dct(band_bytes.getvalue())
+        if not np.array_equal(band.qt, jpeg.qt) or not np.array_equal(
+            band.quant_tbl_no, jpeg.quant_tbl_no
+        ):
+            return None
+
+    out_components = []
+    for index, (src, (h_samp, v_samp)) in enumerate(zip(components, sampling)):
+        block_width = mcu_width // h_samp
+        block_height = mcu_height // v_samp
+        tile_width = TILE_SIZE // block_width
+        tile_height = TILE_SIZE // block_height
+
+        if (
+            src.shape[0] < height_pieces * tile_height
+            or src.shape[1] < width_pieces * tile_width
+        ):
+            return None
+
+        grid = _permute_tiles(
+            src[: height_pieces * tile_height, : width_pieces * tile_width],
+            tile_height,
+            tile_width,
+            width_pieces,
+            height_pieces,
+            piece_order,
+        )
+
+        out_height = ceil(height / block_height)
+        out_width = ceil(width / block_width)
+        out = grid[:out_height, :out_width].copy()
+
+        if band is not None:
+            band_component = [band.Y, band.Cb, band.Cr][index]
+            if is_horizontal:
+                row = band_start // block_height
+                out[row:] = band_component[: out_height - row, :out_width]
+            else:
+                column = band_start // block_width
+                out[:, column:] = band_component[:out_height, : out_width - column]
+        elif is_horizontal:
+            row = start // block_height
+            last = grid[(height_pieces - 1) * tile_height :, :out_width]
+            out[row:] = last
+        else:
+            column = start // block_width
+            last = grid[:out_height, (width_pieces - 1) * tile_width :]
+            out[:, column:] = last
+
+        out_components.append(out)
+
+    jpeg.Y = out_components[0]
+    if jpeg.has_chrominance:
+        jpeg.Cb, jpeg.Cr = out_components[1:]
+    jpeg.height = height
+    jpeg.width = width
+
+    fd, path = tempfile.mkstemp(suffix=".jpg")
+    os.close(fd)
+    try:
+        jpeg.write_dct(path)
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+DESCRAMBLE_ENGINES = {
+    "numpy": descramble_numpy,
+    "pillow": descramble_pillow,
+}
+
+
+def init_process(cache_size: int, cache_file: str | None):
+    """
+    Initializer for descrambling worker processes, which each get their own
+    copy of the permutation cache.
+    """
+    permutation_cache.maxsize = cache_size
+    if cache_file is not None:
+        permutation_cache.open(cache_file)
+
+
+def pool_process_page(*args, **kwargs) -> tuple["ProcessedPage", dict[str, int]]:
+    """
+    process_page in a worker process, along with the permutation cache
+    lookups it made, for the parent to count.
+    """
+    before = permutation_cache.stats()
+    page = process_page(*args, **kwargs)
+    after = permutation_cache.stats()
+    return page, {
+        name: after[name] - before[name] for name in ("hits", "disk_hits", "misses")
+    }
+
+
+class ProcessedPage(NamedTuple):
+    raw_ext: str
+    data: bytes
+    ext: str
+    encoder: str
+    encode_time: float
+    # Set instead of data when the page was written straight to disk
+    path: str | None = None
+    # The descrambled image, kept when asked for to join spreads with
+    image: Image.Image | None = None
+    # Page store key of the page, known up front for a descrambled one
+    digest: str | None = None
+
+
+def page_memory(content: bytes) -> int:
+    """
+    Estimate of the memory a downloaded page takes until it is saved: the
+    response, its decoded and descrambled images and the encoded output.
+    """
+    try:
+        with Image.open(BytesIO(content)) as image:
+            pixels = image.width * image.height * len(image.getbands())
+    except (OSError, ValueError):
+        pixels = 0
+    return 2 * len(content) + 2 * pixels
+
+
+def get_raw_ext(url: str, image: Image.Image) -> str:
+    if image.format is None:
+        log.warning(f"Image is of unknown type: {url}")
+        return "bin"
+    elif image.format == "JPEG":
+        return "jpg"
+    else:
+        return image.format.lower()
+
+
+def process_page(
+    url: str,
+    content: bytes | str,
+    key: list[int] | None,
+    engine: str,
+    page_format: str = "png",
+    compress_level: int | None = None,
+    dest: str | None = None,
+    keep_image: bool = False,
+    store: str | None = None,
+) -> ProcessedPage:
+    """
+    Decode, descramble and encode a downloaded page.
+
+    This is a plain function of its arguments so it can run in a worker
+    process as well as in the download thread. Unkeyed pages are passed
+    through as they came from the server.
+    --------------------------
+    param: content -- bytes or string
+        The downloaded page, or the path of a file holding it
+    param: dest -- string
+        Path without extension to write a keyed page to, instead of
+        returning its bytes
+    param: keep_image -- bool
+        Return the descrambled image along with the encoded page
+    param: store -- string
+        Page store folder. A descrambled page found there is not encoded,
+        its stored file is returned as path, or linked to dest
+    """
+    source = BytesIO(content) if isinstance(content, bytes) else content
+    with Image.open(source) as image:
+        return process_image(
+            url,
+            image,
+            key,
+            engine,
+            page_format,
+            compress_level,
+            content,
+            dest,
+            keep_image,
+            store,
+        )
+
+
+def process_image(
+    url: str,
+    image: Image.Image,
+    key: list[int] | None,
+    engine: str,
+    page_format: str = "png",
+    compress_level: int | None = None,
+    content: bytes | str | None = None,
+    dest: str | None = None,
+    keep_image: bool = False,
+    store: str | None = None,
+) -> ProcessedPage:
+    """
+    Descramble and encode an already opened page, see process_page.
+    The jpeg engine needs the original content and falls back to numpy
+    without it.
+    """
+    raw_ext = get_raw_ext(url, image)
+
+    if key is None or len(key) == 0:
+        data = content if isinstance(content, bytes) else b""
+        return ProcessedPage(raw_ext, data, raw_ext, "raw", 0.0)
+
+    reordered = shuffle_array(key, key.pop())
+
+    xor = reordered[2]
+    width = reordered[0] ^ xor
+    height = reordered[1] ^ xor
+
+    log.debug(f"Image: {width}x{height}, seed {xor}")
+
+    width_pieces, height_pieces = get_tile_layout(width, height)[2:]
+
+    piece_order = randomize(list(range(width_pieces * height_pieces)), xor)
+    log.debug(f"Piece order: {piece_order}")
+
+    if engine == "jpeg":
+        start = perf_counter()
+        data = None
+        if content is not None:
+            data = descramble_jpeg(content, image, width, height, piece_order)
+        if data is not None:
+            encode_time = perf_counter() - start
+            if dest is None:
+                return ProcessedPage(raw_ext, data, "jpg", "jpeg-dct", encode_time)
+
+            path = f"{dest}.jpg"
+            detach_file(path)
+            with open(path, "wb") as f:
+                f.write(data)
+            return ProcessedPage(raw_ext, b"", "jpg", "jpeg-dct", encode_time, path)
+
+        log.debug(f"Falling back to pixel descrambling: {url}")
+        engine = "numpy"
+
+    out = DESCRAMBLE_ENGINES[engine](image, width, height, piece_order)
+    kept = out if keep_image else None
+
+    digest = None
+    if store is not None:
+        digest = image_digest(out, page_format, compress_level)
+        stored = store_path(store, digest, page_format)
+        if os.path.exists(stored):
+            if dest is not None:
+                link_file(stored, f"{dest}.{page_format}")
+                stored = f"{dest}.{page_format}"
+            return ProcessedPage(
+                raw_ext, b"", page_format, "dedup", 0.0, stored, kept, digest
+            )
+
+    if dest is None:
+        data, ext, encode_time = encode_page(out, page_format, compress_level)
+        return ProcessedPage(
+            raw_ext, data, ext, page_format, encode_time, None, kept, digest
+        )
+
+    path = f"{dest}.{page_format}"
+    detach_file(path)
+    with open(path, "wb") as f:
+        ext, encode_time = write_page(out, f, page_format, compress_level)
+    return ProcessedPage(
+        raw_ext, b"", ext, page_format, encode_time, path, kept, digest
+    )
@@ -1,22 +1,27 @@
 import concurrent.futures
 import json
 import logging
+import multiprocessing
 import os
 import shutil
 import subprocess
+import threading
+from heapq import heappop, heappush
 from base64 import b64decode
-from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor
-from http import cookiejar
 from io import BytesIO
-from math import ceil
-from time import sleep
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
+from dataclasses import dataclass, field
+from http import cookiejar
+from time import monotonic, perf_counter, sleep
+from typing import Any
 
 import curl_cffi
 import lxml.builder
 import lxml.etree
-from bs4 import BeautifulSoup
-from PIL import Image
+from PIL import Image, ImageFile
 from tqdm import tqdm
 
 from consts import (
@@ -32,22 +37,83 @@ from consts import (
     WAIT,
     ZIP,
     OPTIMIZE,
+    OPTIMIZE_TIMEOUT,
+    PAGE_STORE,
+    MEMORY_BUDGET,
+    STATE_DB,
+    CATALOG,
+    DESCRAMBLE_ENGINE,
+    PERMUTATION_CACHE_FILE,
+    PERMUTATION_CACHE_SIZE,
+    DOWNLOAD_WORKERS,
+    PAGE_FORMAT,
+    COMPRESS_LEVEL,
+    STREAM,
+    LOOKAHEAD,
+    ADAPTIVE,
+    MAX_DOWNLOAD_WORKERS,
+    RETRIES,
+    RETRY_BACKOFF,
+    HTTP_CACHE_FILE,
+    HTTP_CACHE_TTL,
+    HTTP_CACHE_SIZE,
+    HTML_PARSER,
+    API_FIRST,
+    ARCHIVE_COMPRESSION,
+    DIRECT_CBZ,
+)
+from descramble import (
+    JPEG_DCT_AVAILABLE,
+    ProcessedPage,
+    get_raw_ext,
+    init_process,
+    pool_process_page,
+    page_memory,
+    process_image,
+    process_page,
+)
+from archive import ArchiveBuilder, PageArchive
+from catalog import Catalog, entry_from_metadata
+from encoders import EncodeStats, encode_page, write_page
+from http_cache import ResponseCache
+from gallery_parser import GALLERY_PARSERS
+from flow_control import (
+    AIMDController,
+    MemoryBudget,
+    MemoryReservation,
+    RateLimiter,
+    backoff_delay,
+    is_congestion_status,
 )
+from manifest import PageManifest
+from optimizer import PageOptimizer
+from page_store import PageStore, data_digest, detach_file, image_digest, link_file
+from proxy_pool import ProxyPool
+from spreads import SpreadJoiner
+from url_store import UrlStore
 from utils import (
+    LazyKeys,
     append_images,
     calculate_decryption_key,
     decode_xor_cipher,
     fix_filename,
     get_urls_list,
     many_to_one,
-    randomize,
-    shuffle_array,
+    permutation_cache,
+    url_chapter_id,
 )
 
 log = logging.getLogger(__name__)
 E = lxml.builder.ElementMaker()
 
 
+def response_size(resp, stream: bool = False) -> int:
+    """Body size of a response, from content-length if it is streamed."""
+    if stream:
+        return int(resp.headers.get("content-length") or 0)
+    return len(resp.content)
+
+
 class DescrambleDownloader:
     """Class for downloading galleries.
 
@@ -69,21 +135,132 @@ class DescrambleDownloader:
         proxy=None,
         response=False,
         optimize=OPTIMIZE,
+        optimize_workers=None,
+        optimize_timeout=OPTIMIZE_TIMEOUT,
+        descramble_engine=DESCRAMBLE_ENGINE,
+        permutation_cache_size=PERMUTATION_CACHE_SIZE,
+        permutation_cache_file=PERMUTATION_CACHE_FILE,
+        download_workers=DOWNLOAD_WORKERS,
+        descramble_workers=None,
+        page_format=PAGE_FORMAT,
+        compress_level=COMPRESS_LEVEL,
+        stream=STREAM,
+        lookahead=LOOKAHEAD,
+        adaptive=ADAPTIVE,
+        max_download_workers=MAX_DOWNLOAD_WORKERS,
+        retries=RETRIES,
+        retry_backoff=RETRY_BACKOFF,
+        http_cache_file=HTTP_CACHE_FILE,
+        http_cache_ttl=HTTP_CACHE_TTL,
+        http_cache_size=HTTP_CACHE_SIZE,
+        request_rates=None,
+        byte_rates=None,
+        html_parser=HTML_PARSER,
+        api_first=API_FIRST,
+        direct_cbz=DIRECT_CBZ,
+        archive_compression=ARCHIVE_COMPRESSION,
+        archive_workers=None,
+        page_store=PAGE_STORE,
+        memory_budget=MEMORY_BUDGET,
+        state_db=STATE_DB,
+        catalog=CATALOG,
     ):
         self.done_file = done_file
-        self.urls, self.done_urls = get_urls_list(urls_file, done_file)
+        self.done_lock = threading.Lock()
+        if state_db is not None:
+            self.url_store = UrlStore(state_db)
+            self.urls = self.url_store.pending()
+            self.done_urls = None
+            if not self.urls:
+                log.info("Nothing to rip")
+                exit()
+        else:
+            self.url_store = None
+            self.urls, self.done_urls = get_urls_list(urls_file, done_file)
+        self.catalog = Catalog(catalog) if catalog else None
+        # urls skipped as their gallery is in the library, to the path of it
+        self.in_library: dict[str, str] = {}
         self.root_manga_dir = root_manga_dir
         self.root_response_dir = root_response_dir
 
         self.save_metadata = save_metadata
+        self.html_parser = html_parser
+        self.api_first = api_first
 
         self.timeout = timeout
         self.wait = wait
 
         self.zip = _zip
+        self.page_store = PageStore(page_store) if page_store else None
+        if memory_budget:
+            self.memory_budget = MemoryBudget(memory_budget * 2**20)
+        else:
+            self.memory_budget = None
+        if _zip:
+            self.archive_builder = ArchiveBuilder(archive_compression, archive_workers)
+        else:
+            self.archive_builder = None
 
         self.keep_response = response
 
+        if descramble_engine == "jpeg" and not JPEG_DCT_AVAILABLE:
+            log.warning("jpeglib not found, descrambling JPEG pages in pixels")
+            descramble_engine = "numpy"
+        self.descramble_engine = descramble_engine
+
+        self.page_format = page_format
+        self.compress_level = compress_level
+        self.encode_stats = EncodeStats()
+
+        self.stream = stream
+
+        self.lookahead = lookahead
+
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        if http_cache_file is not None:
+            self.http_cache = ResponseCache(
+                http_cache_file, http_cache_ttl, http_cache_size * 2**20
+            )
+        else:
+            self.http_cache = None
+
+        permutation_cache.maxsize = permutation_cache_size
+        if permutation_cache_file is not None:
+            permutation_cache.open(permutation_cache_file)
+
+        self.download_workers = download_workers
+        if adaptive:
+            self.controller = AIMDController(
+                initial=download_workers,
+                maximum=max(download_workers, max_download_workers),
+                wait=wait,
+            )
+        else:
+            self.controller = None
+
+        if request_rates or byte_rates:
+            self.rate_limiter = RateLimiter(request_rates, byte_rates)
+        else:
+            self.rate_limiter = None
+        if descramble_workers is not None:
+            log.debug(f"Descrambling in {descramble_workers} worker processes")
+            # the download threads are running already, so workers are not
+            # forked from this process with whatever locks they hold
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context("forkserver")
+            else:
+                mp_context = multiprocessing.get_context("spawn")
+            self.descramble_pool = ProcessPoolExecutor(
+                max_workers=descramble_workers,
+                mp_context=mp_context,
+                initializer=init_process,
+                initargs=(permutation_cache_size, permutation_cache_file),
+            )
+        else:
+            self.descramble_pool = None
+
         if optimize:
             if shutil.which("pingo") is not None:
                 self.optimize = "pingo"
@@ -92,12 +269,35 @@ class DescrambleDownloader:
             else:
                 log.warning("Pingo/ECT not found, disabling optimization")
                 self.optimize = None
+        else:
+            self.optimize = None
+        if self.optimize is not None:
+            self.optimizer = PageOptimizer(
+                self.optimize, optimize_workers, optimize_timeout
+            )
+        else:
+            self.optimizer = None
+
+        self.direct_cbz = direct_cbz
+        if direct_cbz and not _zip:
+            log.warning("No cbz is written with --nozip, ignoring --direct_cbz")
+            self.direct_cbz = False
+        elif direct_cbz and self.optimize is not None:
+            log.warning(
+                f"{self.optimize} optimizes pages on disk, "
+                "writing the cbz after the download"
+            )
+            self.direct_cbz = False
 
+        if isinstance(proxy, str):
+            proxy = [proxy]
+        self.proxies = list(proxy or [])
+        self.proxy = self.proxies[0] if self.proxies else None
         self.cookie_jar = cookiejar.MozillaCookieJar(cookies_file)
         self.cookie_jar.load()
 
         self.session = curl_cffi.Session(
-            cookies=self.cookie_jar, proxy=proxy, impersonate="chrome"
+            cookies=self.cookie_jar, proxy=self.proxy, impersonate="chrome"
         )
         self.session.headers.update(
             {
@@ -107,71 +307,38 @@ class DescrambleDownloader:
             }
         )
 
-    def add_done_url(self, url: str):
-        self.done_urls.add(url)
-
-        with open(self.done_file, "a") as done_file_obj:
-            done_file_obj.write(f"{url}\n")
-
-    def get_page_metadata(self, doc: BeautifulSoup) -> OrderedDict:
-        metadata = OrderedDict()
-
-        if self.save_metadata == "basic":
-            return metadata
-
-        log.debug("Parsing right side for metadata")
-
-        meta_rows = doc.select(
-            'div[class^="block md:table-cell relative w-full align-top"] div[class^="table text-sm w-full"]'
-        )
+        # Gallery pages and the API always go through the first proxy, page
+        # images are spread over all of them.
+        self.proxy_sessions: dict[str, curl_cffi.Session] = {}
+        if len(self.proxies) > 1:
+            log.info(f"Spreading page requests over {len(self.proxies)} proxies")
+            self.proxy_pool = ProxyPool(self.proxies)
+            for url in self.proxies[1:]:
+                session = curl_cffi.Session(
+                    cookies=self.cookie_jar, proxy=url, impersonate="chrome"
+                )
+                session.headers.update(self.session.headers)
+                self.proxy_sessions[url] = session
+        else:
+            self.proxy_pool = None
 
-        log.debug("Parsing right side rows")
-        for row in meta_rows:
-            meta_row_left = row.select_one(
-                'div[class^="inline-block w-24 text-left align-top"]'
-            )
-            left_text = meta_row_left.text.strip() if meta_row_left is not None else ""
-
-            if not left_text or left_text in [
-                "Artist",
-                "Parody",
-                "Publisher",
-                "Language",
-                "Pages",
-                "Direction",
-            ]:
-                continue
+    def is_done_url(self, url: str) -> bool:
+        if self.url_store is not None:
+            return self.url_store.is_done(url)
+        assert self.done_urls is not None
+        return url in self.done_urls
 
-            log.debug(f"Parsing {left_text}")
-            meta_row_right = row.select_one(
-                'div[class^="table-cell w-full align-top text-left"]'
-            )
-            if meta_row_right is not None:
-                a_tags = meta_row_right.select("a")
-                if len(a_tags) > 0:
-                    metadata[left_text] = [
-                        a_tag.text.strip() for a_tag in a_tags if a_tag.text != "+"
-                    ]
-                else:
-                    if left_text in ["Favorites"]:
-                        metadata[left_text] = int(
-                            "".join(
-                                meta_row_right.text.strip().split(" ")[0].split(",")
-                            )
-                        )
-                    else:
-                        metadata[left_text] = meta_row_right.text.strip()
+    def add_done_url(self, url: str):
+        if self.url_store is not None:
+            self.url_store.done(url)
+            return
 
-        log.debug("Parsing left side for metadata")
-        price_elem = doc.select_one(
-            'div[class^="block sm:inline-block relative w-full align-top"] div[class^="rounded cursor-pointer right"] div[class^="table w-auto text-right opacity-90 hover:opacity-100 js-purchase-product"] div'
-        )
-        if price_elem is not None:
-            price = float(price_elem.text[1:])
-            metadata["Price"] = price
+        assert self.done_urls is not None
+        with self.done_lock:
+            self.done_urls.add(url)
 
-        # log.debug("Parsing bottom")
-        return metadata
+            with open(self.done_file, "a") as done_file_obj:
+                done_file_obj.write(f"{url}\n")
 
     def get_api_metadata(self, metadata: dict, api_data: dict):
         metadata_api = OrderedDict()
@@ -257,100 +424,321 @@ class DescrambleDownloader:
 
         return metadata_api, manga_folder, response_folder, direction
 
-    def _download_page(
-        self,
-        url: str,
-        key: list[int] | None = None,
-    ) -> tuple[bytes, str, bytes, str]:
-        resp = self.session.get(
-            url,
-            headers={
+    def _image_request(self, url: str) -> dict:
+        return {
+            "url": url,
+            "headers": {
                 "accept": "image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8,*/*;q=0.5",
                 "connection": "keep-alive",
                 "sec-fetch-dest": "image",
                 "sec-fetch-mode": "no-cors",
                 "sec-fetch-site": "same-site",
             },
-        )
+        }
 
-        content = resp.content
+    def _get(self, request: dict, stream: bool = False, session=None):
+        """
+        session.get that waits for the rate limiter and reports latency and
+        pushback to the concurrency controller.
+        """
+        if session is None:
+            session = self.session
 
-        with Image.open(BytesIO(content)) as image:
-            if image.format is None:
-                log.warning(f"Image is of unknown type: {url}")
-                raw_ext = "bin"
-            elif image.format == "JPEG":
-                raw_ext = "jpg"
-            else:
-                raw_ext = image.format.lower()
-
-            if key is None or len(key) == 0:
-                return content, raw_ext, content, raw_ext
+        if self.rate_limiter is not None:
+            sleep(self.rate_limiter.delay(request["url"]))
 
-            reordered = shuffle_array(key, key.pop())
+        if self.controller is None:
+            resp = session.get(**request, stream=stream)
+        else:
+            start = perf_counter()
+            try:
+                resp = session.get(**request, stream=stream)
+            except curl_cffi.CurlError:
+                self.controller.record(None, congested=True)
+                raise
+            self.controller.record(
+                perf_counter() - start, is_congestion_status(resp.status_code)
+            )
 
-            xor = reordered[2]
-            width = reordered[0] ^ xor
-            height = reordered[1] ^ xor
+        if self.rate_limiter is not None:
+            self.rate_limiter.charge(request["url"], response_size(resp, stream))
+
+        return resp
+
+    @staticmethod
+    def _cache_session(cookies) -> str:
+        """Response cache identity of a session, from its fakku_zid cookie."""
+        fakku_zid = cookies.get(name="fakku_zid", domain=".fakku.net") or ""
+        return data_digest(fakku_zid.encode())[:16]
+
+    def _get_cached(self, request: dict):
+        """
+        _get through the response cache, for gallery HTML and API requests.
+        """
+        if self.http_cache is None:
+            return self._get(request)
+
+        session = self._cache_session(self.session.cookies)
+        cached, conditional = self.http_cache.lookup(request["url"], session)
+        if cached is not None:
+            return cached
+
+        request = {**request, "headers": {**request["headers"], **conditional}}
+        return self.http_cache.update(request["url"], self._get(request), session)
+
+    def _get_proxied(self, request: dict, stream: bool = False):
+        """
+        _get through a proxy picked by the pool, reporting how it went.
+        Streamed responses are measured up to their headers, by their
+        content-length.
+        """
+        assert self.proxy_pool is not None
+        proxy = self.proxy_pool.choose()
+
+        start = perf_counter()
+        try:
+            resp = self._get(
+                request, stream, self.proxy_sessions.get(proxy, self.session)
+            )
+        except curl_cffi.CurlError:
+            self.proxy_pool.record(proxy, 0, perf_counter() - start, failed=True)
+            raise
+
+        self.proxy_pool.record(
+            proxy,
+            response_size(resp, stream),
+            perf_counter() - start,
+            resp.status_code >= 400,
+        )
+        return resp
 
-            log.debug(f"Image: {width}x{height}, seed {xor}")
+    def _get_page(self, url: str, stream: bool = False):
+        if self.proxy_pool is None:
+            resp = self._get(self._image_request(url), stream=stream)
+        else:
+            resp = self._get_proxied(self._image_request(url), stream=stream)
+        resp.raise_for_status()
+        return resp
 
-            is_horizontal = width > height
-            if is_horizontal:
-                smaller_edge = height
-            else:
-                smaller_edge = width
+    def _page_slot(self):
+        if self.controller is None:
+            return nullcontext()
+        return self.controller.slot()
 
-            offset = 128 * ceil(smaller_edge / 128) - smaller_edge
-            width_pieces = ceil(width / 128)
-            height_pieces = ceil(height / 128)
+    def _page_memory(self):
+        """Room for one more page in the memory budget."""
+        if self.memory_budget is None:
+            return nullcontext()
+        return self.memory_budget.reserve()
 
-            out = Image.new("RGB", (width, height))
+    def _download_page(
+        self,
+        url: str,
+        key: list[int] | None = None,
+        keep_image: bool = False,
+        reservation: MemoryReservation | None = None,
+    ) -> tuple[bytes, ProcessedPage]:
+        with self._page_slot():
+            content = self._get_page(url).content
+        if reservation is not None:
+            assert self.memory_budget is not None
+            self.memory_budget.charge(reservation, page_memory(content))
+        return content, self._process_page(url, content, key, keep_image)
+
+    def _process_page(
+        self,
+        url: str,
+        content: bytes,
+        key: list[int] | None,
+        keep_image: bool = False,
+    ) -> ProcessedPage:
+        """
+        Descramble and encode a downloaded page, in the process pool if
+        there is one. The descrambled image is only kept without the pool.
+        """
+        args = (
+            url,
+            content,
+            key,
+            self.descramble_engine,
+            self.page_format,
+            self.compress_level,
+        )
+        store = self.page_store.root if self.page_store is not None else None
+        if self.descramble_pool is not None:
+            page = self._pool_process_page(*args, store=store)
+        else:
+            page = process_page(*args, keep_image=keep_image, store=store)
 
-            piece_order = randomize(list(range(width_pieces * height_pieces)), xor)
-            log.debug(f"Piece order: {piece_order}")
+        if page.encoder == "dedup":
+            assert self.page_store is not None
+            assert page.path is not None and page.digest is not None
+            self.page_store.hit(page.digest, page.path)
+        else:
+            self.encode_stats.add(page.encoder, page.encode_time, len(page.data))
+
+        return page
+
+    def _pool_process_page(self, *args, **kwargs) -> ProcessedPage:
+        """process_page in the process pool, counting its permutation lookups."""
+        assert self.descramble_pool is not None
+        page, stats = self.descramble_pool.submit(
+            pool_process_page, *args, **kwargs
+        ).result()
+        permutation_cache.add_stats(stats)
+        return page
+
+    def _store_page(self, page: ProcessedPage) -> tuple[str, str]:
+        """
+        Put a processed page in the page store.
+        --------------------------
+        return: (digest, path) -- tuple
+            Its page store key and the page in the store
+        """
+        assert self.page_store is not None
+        if page.path is not None:
+            # taken from the store
+            assert page.digest is not None
+            return page.digest, page.path
+
+        digest = page.digest or data_digest(page.data)
+        stored = self.page_store.find(digest, page.ext)
+        if stored is not None:
+            self.page_store.hit(digest, stored)
+            return digest, stored
+        return digest, self.page_store.add_data(
+            digest, page.ext, page.data, page.encode_time
+        )
 
-            for index, value in enumerate(piece_order):
-                sx_piece = value % width_pieces
-                sy_piece = (value - sx_piece) // width_pieces
-                dx_piece = index % width_pieces
-                dy_piece = (index - dx_piece) // width_pieces
+    def _stream_page(
+        self,
+        url: str,
+        key: list[int] | None,
+        dest: str,
+        response_dest: str,
+        keep_image: bool = False,
+    ) -> ProcessedPage:
+        """
+        Download a page without holding the whole response in memory.
+
+        Keyed pages descrambled in this thread are fed chunk by chunk to an
+        incremental image parser. Everything else is streamed to a temporary
+        file, which is renamed into place for unkeyed pages or handed by path
+        to the descrambler, so the body is never copied into memory.
+        --------------------------
+        param: dest -- string
+            Path of the page without extension
+        param: response_dest -- string
+            Path of the raw response without extension, used with keep_response
+        return: page -- ProcessedPage
+            The page, with its path set and no data
+        """
+        store = self.page_store.root if self.page_store is not None else None
+        resp = self._get_page(url, stream=True)
+        try:
+            if (
+                key
+                and self.descramble_engine != "jpeg"
+                and self.descramble_pool is None
+            ):
+                parser = ImageFile.Parser()
+                raw_file = None
+                if self.keep_response:
+                    raw_file = open(f"{response_dest}.part", "wb")
+                try:
+                    for chunk in resp.iter_content():
+                        parser.feed(chunk)
+                        if raw_file is not None:
+                            raw_file.write(chunk)
+                finally:
+                    if raw_file is not None:
+                        raw_file.close()
+
+                with parser.close() as image:
+                    page = process_image(
+                        url,
+                        image,
+                        key,
+                        self.descramble_engine,
+                        self.page_format,
+                        self.compress_level,
+                        dest=dest,
+                        keep_image=keep_image,
+                        store=store,
+                    )
 
-                if is_horizontal:
-                    last_piece = dy_piece == height_pieces - 1
+                if raw_file is not None:
+                    os.replace(
+                        f"{response_dest}.part", f"{response_dest}.{page.raw_ext}"
+                    )
+            else:
+                part = f"{response_dest if self.keep_response else dest}.part"
+                with open(part, "wb") as f:
+                    for chunk in resp.iter_content():
+                        f.write(chunk)
+
+                if key:
+                    args = (
+                        url,
+                        part,
+                        key,
+                        self.descramble_engine,
+                        self.page_format,
+                        self.compress_level,
+                        dest,
+                    )
+                    if self.descramble_pool is not None:
+                        page = self._pool_process_page(*args, store=store)
+                    else:
+                        page = process_page(*args, keep_image=keep_image, store=store)
                 else:
-                    last_piece = dx_piece == width_pieces - 1
-
-                dx = dx_piece * 128
-                dy = dy_piece * 128
-
-                if last_piece:
-                    dx -= 0 if is_horizontal else offset
-                    dy -= offset if is_horizontal else 0
-
-                sx = sx_piece * 128
-                sy = sy_piece * 128
-
-                out.paste(image.crop((sx, sy, sx + 128, sy + 128)), (dx, dy))
-
-            out_bytes = BytesIO()
-            out.save(out_bytes, "PNG", quality=100, optimize=True)
-            out_bytes.seek(0)
-
-            return content, raw_ext, out_bytes.read(), "png"
-
-    def _is_gallery_available(self, doc) -> str | None:
-        for elem in doc.select('a[class^="button-green"]'):
-            if "Start Reading" in elem.text:
-                return elem["href"]
+                    with Image.open(part) as image:
+                        raw_ext = get_raw_ext(url, image)
+                    path = f"{dest}.{raw_ext}"
+                    detach_file(path)
+                    if self.keep_response:
+                        shutil.copyfile(part, path)
+                    else:
+                        os.replace(part, path)
+                    page = ProcessedPage(raw_ext, b"", raw_ext, "raw", 0.0, path)
+
+                if self.keep_response:
+                    os.replace(part, f"{response_dest}.{page.raw_ext}")
+                elif os.path.exists(part):
+                    os.remove(part)
+        finally:
+            resp.close()
+
+        assert page.path is not None
+        if self.page_store is None:
+            self.encode_stats.add(
+                page.encoder, page.encode_time, os.path.getsize(page.path)
+            )
+        elif page.encoder == "dedup":
+            assert page.digest is not None
+            self.page_store.hit(page.digest, page.path)
+        else:
+            self.encode_stats.add(
+                page.encoder, page.encode_time, os.path.getsize(page.path)
+            )
+            if page.digest is not None:
+                self.page_store.add_file(page.digest, page.path, page.encode_time)
+            else:
+                page = page._replace(digest=self.page_store.dedupe_file(page.path))
+            if self.keep_response:
+                self.page_store.dedupe_file(f"{response_dest}.{page.raw_ext}")
 
-        return None
+        return page
 
     def _build_comicinfo_xml(self, metadata: dict) -> bytes:
         if isinstance(metadata["Artist"], list):
             artist = ", ".join(metadata["Artist"])
         else:
             artist = metadata["Artist"]
+        if isinstance(metadata["Tags"], list):
+            tags = ", ".join(metadata["Tags"])
+        else:
+            tags = metadata["Tags"]
 
         doc: lxml.etree.Element = E.ComicInfo(
             E.Title(metadata["Title"]),
@@ -359,7 +747,7 @@ class DescrambleDownloader:
             E.LanguageISO(LANG_MAP[metadata["Language"]]),
             E.PageCount(metadata["Pages"]),
             E.Web(metadata["URL"]),
-            E.Genre(", ".join(metadata["Tags"])),
+            E.Genre(tags),
             E.Publisher(metadata["Publisher"]),
             E.Manga("Yes"),
         )
@@ -376,287 +764,923 @@ class DescrambleDownloader:
             doc, pretty_print=True
         )
 
-    def load_all(self):
-        log.debug("Starting main downloader function")
+    def _gallery_page_request(self, url: str) -> dict:
+        return {
+            "url": url,
+            "headers": {
+                "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+                "connection": "keep-alive",
+                "sec-fetch-dest": "document",
+                "sec-fetch-mode": "navigate",
+                "sec-fetch-site": "same-origin",
+                "sec-fetch-user": "?1",
+            },
+        }
+
+    def _read_page_request(self, url: str) -> dict:
+        return {
+            "url": f"{url}/read",
+            "headers": {
+                "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+                "referer": url,
+                "sec-fetch-dest": "document",
+                "sec-fetch-mode": "navigate",
+                "sec-fetch-site": "same-origin",
+                "sec-fetch-user": "?1",
+            },
+        }
+
+    def _api_request(self, chapter_id: str) -> dict:
+        return {
+            "url": f"{API_URL}/hentai/{chapter_id}/read",
+            "headers": {
+                "accept": "*/*",
+                "sec-fetch-dest": "empty",
+                "sec-fetch-mode": "cors",
+                "sec-fetch-site": "same-site",
+            },
+        }
 
-        if not os.path.exists(self.root_manga_dir):
-            os.mkdir(self.root_manga_dir)
-        if not os.path.exists(self.root_response_dir):
-            os.mkdir(self.root_response_dir)
+    def _parse_gallery_page(
+        self, url: str, content: bytes, encoding: str | None = None
+    ) -> tuple[str, OrderedDict] | None:
+        """
+        Find the chapter id and page metadata of a gallery.
+        Returns None if the gallery should be skipped.
+        """
+        parser = GALLERY_PARSERS[self.html_parser]
+        doc = parser.parse(content, encoding or "utf-8")
 
-        urls_processed = 0
-        for url in self.urls:
-            log.info(url)
-
-            resp = self.session.get(
-                url,
-                headers={
-                    "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                    "connection": "keep-alive",
-                    "sec-fetch-dest": "document",
-                    "sec-fetch-mode": "navigate",
-                    "sec-fetch-site": "same-origin",
-                    "sec-fetch-user": "?1",
-                },
-            )
+        log.debug("Checking if gallery is available, green button")
 
-            doc = BeautifulSoup(resp.text, "lxml")
+        href = parser.reader_href(doc)
 
-            log.debug("Checking if gallery is available, green button")
+        if href is None:
+            log.info(f"Gallery is not available: {url}")
+            return None
 
-            href = self._is_gallery_available(doc)
+        if self.save_metadata == "basic":
+            metadata = OrderedDict()
+        else:
+            metadata = parser.page_metadata(doc)
 
-            if href is None:
-                log.info(f"Gallery is not available: {url}")
-                urls_processed += 1
-                continue
+        href_parts = href.split("/")
 
-            metadata = self.get_page_metadata(doc)
+        # /hentai/{chapter_id}/read
+        if href.endswith("/"):
+            chapter_id = href_parts[-3]
+        else:
+            chapter_id = href_parts[-2]
 
-            href_parts = href.split("/")
+        if self._redirects_to_done(url, chapter_id):
+            return None
 
-            # /hentai/{chapter_id}/read
-            if href.endswith("/"):
-                chapter_id = href_parts[-3]
-            else:
-                chapter_id = href_parts[-2]
+        return chapter_id, metadata
 
-            if f"https://www.fakku.net/hentai/{chapter_id}" in self.done_urls:
-                log.info(
-                    "URL redirects to a done hentai: https://www.fakku.net/hentai/%s",
-                    chapter_id,
-                )
-                urls_processed += 1
-                self.add_done_url(url)
-                continue
+    def _parse_page_metadata(
+        self, content: bytes, encoding: str | None = None
+    ) -> OrderedDict:
+        parser = GALLERY_PARSERS[self.html_parser]
+        return parser.page_metadata(parser.parse(content, encoding or "utf-8"))
 
-            log.info(f'Downloading "{chapter_id}" manga.')
-
-            resp = self.session.get(
-                f"{url}/read",
-                headers={
-                    "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                    "referer": url,
-                    "sec-fetch-dest": "document",
-                    "sec-fetch-mode": "navigate",
-                    "sec-fetch-site": "same-origin",
-                    "sec-fetch-user": "?1",
-                },
+    def _redirects_to_done(self, url: str, chapter_id: str) -> bool:
+        if self.is_done_url(f"https://www.fakku.net/hentai/{chapter_id}"):
+            log.info(
+                "URL redirects to a done hentai: https://www.fakku.net/hentai/%s",
+                chapter_id,
             )
-
-            if "You do not have access to this content." in resp.text:
-                log.info(f"You do not have access to this content: {url}")
-                urls_processed += 1
+            self.add_done_url(url)
+            return True
+
+        if self.catalog is not None:
+            # the catalog may be out of date, only skip what is still there,
+            # and leave the url to be checked again on the next run
+            for entry in self.catalog.find_chapter(chapter_id):
+                if os.path.exists(entry.path):
+                    log.info("Already in the library: %s", entry.path)
+                    self.in_library[url] = entry.path
+                    return True
+
+        return False
+
+    def _api_chapter_id(self, resp) -> str | None:
+        """
+        Chapter id of a gallery from a reader API response requested with the
+        id in its url. None if the response cannot stand in for the gallery
+        and /read pages, so they have to be fetched.
+        """
+        if resp.status_code != 200:
+            return None
+
+        try:
+            api_data = resp.json()
+        except json.decoder.JSONDecodeError:
+            return None
+
+        if (
+            not isinstance(api_data, dict)
+            or "pages" not in api_data
+            or "content_url" not in api_data.get("content", {})
+        ):
+            return None
+
+        # the canonical url, different from ours if the gallery was renamed
+        return url_chapter_id(api_data["content"]["content_url"])
+
+    def _has_access(self, url: str, html: str) -> bool:
+        if "You do not have access to this content." in html:
+            log.info(f"You do not have access to this content: {url}")
+            return False
+
+        return True
+
+    def _prepare_gallery(
+        self, url: str, chapter_id: str, metadata: OrderedDict, resp, cookies
+    ) -> "Gallery | None":
+        """
+        Set up folders, keys and spreads of a gallery from its reader API
+        response. Returns None if the gallery should be skipped.
+        """
+        try:
+            api_data = resp.json()
+        except json.decoder.JSONDecodeError:
+            log.info(f"Failed to decode JSON: {url}")
+            return None
+
+        (
+            metadata_api,
+            manga_folder,
+            response_folder,
+            direction,
+        ) = self.get_api_metadata(metadata, api_data)
+
+        for k, v in metadata_api.items():
+            metadata[k] = v
+        log.debug(metadata)
+
+        if self.keep_response:
+            api_dest = os.path.join(response_folder, "api.json")
+            with open(api_dest, "w", encoding="utf-8") as f:
+                json.dump(api_data, f, indent=True, ensure_ascii=False)
+
+        keys: Mapping[str, list[int]] = {}
+
+        if "key_hash" in api_data:
+            fakku_zid = cookies.get(name="fakku_zid", domain=".fakku.net")
+
+            if fakku_zid is None:
+                log.error("Failed to retrieve fakku_zid cookie for descrambling pages")
+                return None
+
+            data = decode_xor_cipher(
+                calculate_decryption_key(api_data["key_hash"], fakku_zid),
+                b64decode(api_data["key_data"]),
+            ).decode("utf-8")
+            keys = LazyKeys(data)
+
+        page_digits = len(str(metadata["Pages"]))
+        padd = max(2, page_digits)
+
+        spreads = dict()
+        for spread in api_data["spreads"]:
+            left = str(spread[0])
+            right = str(spread[-1])
+            if left == right:
                 continue
+            else:
+                spreads[right] = (left, right)
 
-            resp = self.session.get(
-                f"{API_URL}/hentai/{chapter_id}/read",
-                headers={
-                    "accept": "*/*",
-                    "sec-fetch-dest": "empty",
-                    "sec-fetch-mode": "cors",
-                    "sec-fetch-site": "same-site",
-                },
-            )
+        return Gallery(
+            url,
+            chapter_id,
+            metadata,
+            api_data,
+            keys,
+            manga_folder,
+            response_folder,
+            direction,
+            padd,
+            spreads,
+            PageManifest(os.path.join(response_folder, "manifest.jsonl"), manga_folder),
+            SpreadJoiner(spreads.values(), api_data["pages"]),
+        )
 
-            try:
-                api_data = resp.json()
-            except json.decoder.JSONDecodeError:
-                log.info(f"Failed to decode JSON: {url}")
-                urls_processed += 1
-                continue
+    def _url_started(self, url: str):
+        if self.url_store is not None:
+            self.url_store.start(url)
+
+    def _url_failed(self, url: str, error: str):
+        if self.url_store is not None and not self.url_store.is_done(url):
+            self.url_store.fail(url, error)
+
+    def _fetch_tracked(self, url: str) -> "Gallery | None":
+        self._url_started(url)
+        gallery = self._fetch_gallery(url)
+        if gallery is None:
+            self._url_failed(url, self._fetch_error(url))
+        return gallery
+
+    def _fetch_error(self, url: str) -> str:
+        path = self.in_library.pop(url, None)
+        if path is not None:
+            return f"already in the library: {path}"
+        return "gallery could not be fetched"
+
+    def _fetch_gallery(self, url: str) -> "Gallery | None":
+        log.info(url)
+
+        if self.api_first:
+            resp = self._get_cached(self._api_request(url_chapter_id(url)))
+            chapter_id = self._api_chapter_id(resp)
+            if chapter_id is not None:
+                if self._redirects_to_done(url, chapter_id):
+                    return None
+
+                log.info(f'Downloading "{chapter_id}" manga.')
+
+                metadata = OrderedDict()
+                if self.save_metadata != "basic":
+                    page = self._get_cached(self._gallery_page_request(url))
+                    metadata = self._parse_page_metadata(page.content, page.encoding)
+
+                return self._prepare_gallery(
+                    url, chapter_id, metadata, resp, self.session.cookies
+                )
 
-            (
-                metadata_api,
-                manga_folder,
-                response_folder,
-                direction,
-            ) = self.get_api_metadata(metadata, api_data)
+            log.debug("Reader API needs the gallery pages first")
 
-            for k, v in metadata_api.items():
-                metadata[k] = v
-            log.debug(metadata)
+        resp = self._get_cached(self._gallery_page_request(url))
 
-            if self.keep_response:
-                api_dest = os.path.join(response_folder, "api.json")
-                with open(api_dest, "w", encoding="utf-8") as f:
-                    json.dump(api_data, f, indent=True, ensure_ascii=False)
+        parsed = self._parse_gallery_page(url, resp.content, resp.encoding)
+        if parsed is None:
+            return None
+        chapter_id, metadata = parsed
 
-            keys: dict[str, list[int]] = {}
+        log.info(f'Downloading "{chapter_id}" manga.')
 
-            if "key_hash" in api_data:
-                fakku_zid = self.session.cookies.get(
-                    name="fakku_zid", domain=".fakku.net"
-                )
+        resp = self._get_cached(self._read_page_request(url))
 
-                if fakku_zid is None:
-                    log.error(
-                        "Failed to retrieve fakku_zid cookie for descrambling pages"
-                    )
-                    urls_processed += 1
-                    continue
-
-                data = decode_xor_cipher(
-                    calculate_decryption_key(api_data["key_hash"], fakku_zid),
-                    b64decode(api_data["key_data"]),
-                ).decode("utf-8")
-                keys = json.loads(data)
+        if not self._has_access(url, resp.text):
+            return None
 
-            page_digits = len(str(metadata["Pages"]))
-            padd = max(2, page_digits)
+        resp = self._get_cached(self._api_request(chapter_id))
 
-            spreads = dict()
-            for spread in api_data["spreads"]:
-                left = str(spread[0])
-                right = str(spread[-1])
-                if left == right:
-                    continue
-                else:
-                    spreads[right] = (left, right)
-
-            with (
-                tqdm(
-                    total=len(api_data["pages"].values()),
-                    desc="Working...",
-                    unit="page",
-                    leave=False,
-                    position=0,
-                ) as pbar,
-                ThreadPoolExecutor(max_workers=5) as executor,
-            ):
+        return self._prepare_gallery(
+            url, chapter_id, metadata, resp, self.session.cookies
+        )
 
-                def worker(idx: str, page: dict):
-                    num = page["page"]
-                    image_url = page["image"]
+    def _save_page(
+        self,
+        gallery: "Gallery",
+        idx: str,
+        page: dict,
+        raw: bytes,
+        processed: ProcessedPage,
+    ):
+        num = page["page"]
+        raw_filename = f"{num:0{gallery.padd}d}.{processed.raw_ext}"
+        filename = f"{num:0{gallery.padd}d}.{processed.ext}"
+
+        if self.keep_response:
+            resp_dest = os.path.join(gallery.response_folder, raw_filename)
+            detach_file(resp_dest)
+            with open(resp_dest, "wb") as f:
+                f.write(raw)
+            if self.page_store is not None:
+                self.page_store.dedupe_file(resp_dest)
+
+        digest = stored = None
+        if self.page_store is not None:
+            digest, stored = self._store_page(processed)
+
+        if gallery.archive is not None:
+            data = processed.data
+            if processed.path is not None:
+                with open(processed.path, "rb") as f:
+                    data = f.read()
+            gallery.archive.add(
+                idx,
+                f"{num:0{gallery.padd}d}",
+                processed.ext,
+                data,
+                processed.image,
+            )
+            return
 
-                    raw, raw_ext, image, ext = self._download_page(
-                        image_url, keys.get(idx)
-                    )
+        dest = os.path.join(gallery.manga_folder, filename)
+        if stored is not None:
+            link_file(stored, dest)
+        else:
+            detach_file(dest)
+            with open(dest, "wb") as f:
+                f.write(processed.data)
 
-                    raw_filename = f"{num:0{padd}d}.{raw_ext}"
-                    filename = f"{num:0{padd}d}.{ext}"
+        self._page_done(gallery, idx, page, dest, processed.image, digest)
 
-                    if self.keep_response:
-                        resp_dest = os.path.join(response_folder, raw_filename)
-                        with open(resp_dest, "wb") as f:
-                            f.write(raw)
+    def _page_done(
+        self,
+        gallery: "Gallery",
+        idx: str,
+        page: dict,
+        path: str,
+        image: Image.Image | None = None,
+        digest: str | None = None,
+    ):
+        """
+        Record a page written to the folder, and join its spread if the
+        other page is in too.
+        --------------------------
+        param: digest -- string
+            Page store key of the page, if it is in the store
+        """
+        page["image_path"] = path
+        page["digest"] = digest
+        gallery.manifest.add(idx, path)
+
+        if idx in gallery.joiner:
+            halves = gallery.joiner.add(idx, image)
+            if halves is not None:
+                self._join_spread(gallery, idx, halves)
+        else:
+            self._optimize_page(gallery, idx, path, digest)
 
-                    dest = os.path.join(manga_folder, filename)
-                    with open(dest, "wb") as f:
-                        f.write(image)
+    def _optimize_page(
+        self, gallery: "Gallery", key: str, path: str, digest: str | None = None
+    ):
+        """Send a page whose file will not move anymore to the optimizer."""
+        if self.optimizer is None:
+            return
+
+        def done():
+            # the manifest checksum must match the optimized file
+            gallery.manifest.add(key, path)
+            # the page is no longer linked to the store, store the optimized
+            # file in place of the one it came from
+            if self.page_store is not None and digest is not None:
+                self.page_store.replace_file(digest, path)
+
+        gallery.optimizing.append(
+            self.optimizer.submit(path, gallery.response_folder, done)
+        )
 
-                    page["image_path"] = dest
+    def _join_spread(self, gallery: "Gallery", idx: str, halves: dict[str, Any]):
+        """
+        Join the spreads of a group whose pages are all in the folder, in
+        order, from their descrambled images where they were kept and from
+        disk otherwise.
+        """
+        pages = gallery.api_data["pages"]
+        manga_folder = gallery.manga_folder
+        finished = {}
+        for left, right in gallery.joiner.group(idx):
+            im_l = pages[left]["image_path"]
+            im_r = pages[right]["image_path"]
+
+            nam_l, ext_l = os.path.splitext(os.path.basename(im_l))
+            nam_r, ext_r = os.path.splitext(os.path.basename(im_r))
+
+            spread_name = nam_l + "-" + nam_r
+            destination_file_spread = os.path.join(
+                manga_folder, f"{spread_name}a.{self.page_format}"
+            )
 
-                futures = [
-                    executor.submit(worker, idx, page)
-                    for idx, page in api_data["pages"].items()
+            with ExitStack() as stack:
+                images = [
+                    (
+                        halves[key]
+                        if halves[key] is not None
+                        else stack.enter_context(Image.open(path))
+                    )
+                    for key, path in ((left, im_l), (right, im_r))
                 ]
+                digest = self._write_spread(gallery, images, destination_file_spread)
 
-                for future in concurrent.futures.as_completed(futures):
-                    pbar.update()
-                    future.result()
+            pages[left]["image_path"] = destination_file_l = os.path.join(
+                manga_folder, f"{nam_l}b.{ext_l}"
+            )
+            pages[right]["image_path"] = destination_file_r = os.path.join(
+                manga_folder, f"{nam_r}c.{ext_r}"
+            )
 
-            for spread in tqdm(spreads.values(), desc="Joining spreads", unit="spread"):
-                left, right = spread
+            shutil.move(im_l, destination_file_l)
+            shutil.move(im_r, destination_file_r)
+
+            finished[f"{left}-{right}"] = destination_file_spread, digest
+            finished[left] = destination_file_l, pages[left].get("digest")
+            finished[right] = destination_file_r, pages[right].get("digest")
+
+        for key, (path, digest) in finished.items():
+            gallery.manifest.add(key, path)
+            self._optimize_page(gallery, key, path, digest)
+
+    def _join_halves(self, gallery: "Gallery", images: list) -> Image.Image:
+        """Join the two pages of a spread, given as paths or images."""
+        return append_images(
+            images,
+            direction="horizontal",
+            alignment="none",
+            src_type="scrambled" if "key_hash" in gallery.api_data else "unscrambled",
+            dirc=gallery.direction,
+        )
 
-                if left not in api_data["pages"] or right not in api_data["pages"]:
-                    log.warning(
-                        "Requested to join non-existent pages (%s, %s), ignoring",
-                        left,
-                        right,
+    def _find_spread(self, combo: Image.Image) -> tuple[str | None, str | None]:
+        """
+        Look a joined spread up in the page store.
+        --------------------------
+        return: (digest, stored) -- tuple
+            Its page store key and stored file, None without a store or if
+            it is not stored yet
+        """
+        if self.page_store is None:
+            return None, None
+
+        digest = image_digest(combo, self.page_format, self.compress_level)
+        stored = self.page_store.find(digest, self.page_format)
+        if stored is not None:
+            self.page_store.hit(digest, stored)
+        return digest, stored
+
+    def _encode_spread(self, gallery: "Gallery", images: list) -> bytes:
+        """Join the two pages of a spread and encode the result."""
+        combo = self._join_halves(gallery, images)
+        digest, stored = self._find_spread(combo)
+        if stored is not None:
+            with open(stored, "rb") as f:
+                return f.read()
+
+        data, _, encode_time = encode_page(combo, self.page_format, self.compress_level)
+        self.encode_stats.add(self.page_format, encode_time, len(data))
+        if self.page_store is not None and digest is not None:
+            self.page_store.add_data(digest, self.page_format, data, encode_time)
+        return data
+
+    def _write_spread(self, gallery: "Gallery", images: list, dest: str) -> str | None:
+        """
+        Join the two pages of a spread into dest, hardlinked from the page
+        store if the joined page is there already.
+        --------------------------
+        return: digest -- string
+            Page store key of the joined page, None without a store
+        """
+        combo = self._join_halves(gallery, images)
+        digest, stored = self._find_spread(combo)
+        if stored is not None:
+            link_file(stored, dest)
+            return digest
+
+        detach_file(dest)
+        with open(dest, "wb") as f:
+            _, encode_time = write_page(combo, f, self.page_format, self.compress_level)
+        self.encode_stats.add(self.page_format, encode_time, os.path.getsize(dest))
+        if self.page_store is not None and digest is not None:
+            self.page_store.add_file(digest, dest, encode_time)
+        return digest
+
+    def _start_archive(self, gallery: "Gallery"):
+        """
+        Open the cbz pages are written into as they finish, and add the
+        pages an earlier run left in the folder.
+        """
+        pages = gallery.api_data["pages"]
+
+        def join(left: Any, right: Any) -> tuple[str, bytes]:
+            with ExitStack() as stack:
+                images = [
+                    (
+                        stack.enter_context(Image.open(BytesIO(half)))
+                        if isinstance(half, bytes)
+                        else half
                     )
-                    continue
-
-                fin_img = [
-                    api_data["pages"][left]["image_path"],
-                    api_data["pages"][right]["image_path"],
+                    for half in (left, right)
                 ]
-                im_l = fin_img[0]
-                im_r = fin_img[1]
+                return self.page_format, self._encode_spread(gallery, images)
 
-                nam_l, ext_l = os.path.splitext(os.path.basename(im_l))
-                nam_r, ext_r = os.path.splitext(os.path.basename(im_r))
+        gallery.archive = PageArchive(
+            f"{gallery.manga_folder}.cbz",
+            sorted(pages, key=lambda idx: pages[idx]["page"]),
+            gallery.joiner,
+            join,
+        )
 
-                spread_name = nam_l + "-" + nam_r
-                destination_file_spread = os.path.join(
-                    manga_folder, f"{spread_name}a.png"
-                )
+        for idx, page in pages.items():
+            if "image_path" in page:
+                self._archive_file(gallery, idx, page["image_path"])
 
-                combo = append_images(
-                    fin_img,
-                    direction="horizontal",
-                    alignment="none",
-                    src_type="scrambled" if "key_hash" in api_data else "unscrambled",
-                    dirc=direction,
+    def _archive_file(
+        self,
+        gallery: "Gallery",
+        idx: str,
+        path: str,
+        image: Image.Image | None = None,
+    ):
+        assert gallery.archive is not None
+        with open(path, "rb") as f:
+            data = f.read()
+        stem, ext = os.path.splitext(os.path.basename(path))
+        gallery.archive.add(idx, stem, ext[1:], data, image)
+
+    def _resume_pages(self, gallery: "Gallery") -> dict[str, dict]:
+        """
+        Point the pages finished by an earlier run at their files.
+        --------------------------
+        return: pages -- dict
+            The pages still to download
+        """
+        finished = gallery.manifest.load()
+        if finished:
+            log.info(f"Resuming, {len(finished)} pages already downloaded")
+
+        joined = set()
+        for group in gallery.joiner.groups():
+            spreads = [f"{left}-{right}" for left, right in group]
+            if not any(spread in finished for spread in spreads):
+                continue
+            indexes = {idx for spread in group for idx in spread}
+            keys = [*spreads, *indexes]
+            if all(key in finished for key in keys) and not self.direct_cbz:
+                joined.update(indexes)
+                for spread in spreads:
+                    self._optimize_page(gallery, spread, finished[spread])
+                continue
+            # part of a joined group, or one the cbz gets from the pages
+            for key in keys:
+                if key in finished:
+                    os.remove(finished.pop(key))
+
+        pages = {}
+        for idx, page in gallery.api_data["pages"].items():
+            if idx not in finished:
+                pages[idx] = page
+            elif self.direct_cbz:
+                page["image_path"] = finished[idx]
+            elif idx in joined or idx not in gallery.joiner:
+                page["image_path"] = finished[idx]
+                self._optimize_page(gallery, idx, finished[idx])
+            else:
+                self._page_done(gallery, idx, page, finished[idx])
+
+        return pages
+
+    def _retry_page(self, idx: str, attempt: int, error: Exception) -> float | None:
+        """
+        Seconds to wait before retrying a failed page, or None once it is out
+        of retries.
+        """
+        if attempt >= self.retries:
+            log.error(f"Page {idx} failed after {attempt + 1} attempts: {error}")
+            return None
+
+        delay = backoff_delay(attempt, self.retry_backoff)
+        log.warning(f"Page {idx} failed ({error}), retrying in {delay:.1f}s")
+        return delay
+
+    def _download_pages(self, gallery: "Gallery") -> bool:
+        """
+        Download the missing pages of a gallery. Failed pages are retried
+        with backoff, without holding up the rest.
+        --------------------------
+        return: complete -- bool
+            False if some page is still missing
+        """
+        pages = self._resume_pages(gallery)
+        total = len(gallery.api_data["pages"])
+        if self.direct_cbz:
+            self._start_archive(gallery)
+
+        with (
+            tqdm(
+                total=total,
+                initial=total - len(pages),
+                desc="Working...",
+                unit="page",
+                leave=False,
+                position=0,
+            ) as pbar,
+            ThreadPoolExecutor(
+                max_workers=(
+                    self.download_workers
+                    if self.controller is None
+                    else self.controller.maximum
                 )
-                combo.save(destination_file_spread)
+            ) as executor,
+        ):
+
+            def worker(idx: str, page: dict):
+                num = page["page"]
+                image_url = page["image"]
+
+                if self.stream:
+                    with self._page_slot():
+                        processed = self._stream_page(
+                            image_url,
+                            gallery.keys.get(idx),
+                            os.path.join(
+                                gallery.manga_folder, f"{num:0{gallery.padd}d}"
+                            ),
+                            os.path.join(
+                                gallery.response_folder, f"{num:0{gallery.padd}d}"
+                            ),
+                            idx in gallery.joiner,
+                        )
+                    assert processed.path is not None
+                    if gallery.archive is not None:
+                        self._archive_file(
+                            gallery, idx, processed.path, processed.image
+                        )
+                        os.remove(processed.path)
+                    else:
+                        self._page_done(
+                            gallery,
+                            idx,
+                            page,
+                            processed.path,
+                            processed.image,
+                            processed.digest,
+                        )
+                else:
+                    with self._page_memory() as reservation:
+                        raw, processed = self._download_page(
+                            image_url,
+                            gallery.keys.get(idx),
+                            idx in gallery.joiner,
+                            reservation,
+                        )
+                        self._save_page(gallery, idx, page, raw, processed)
 
-                api_data["pages"][left]["image_path"] = destination_file_l = (
-                    os.path.join(manga_folder, f"{nam_l}b.{ext_l}")
-                )
-                api_data["pages"][right]["image_path"] = destination_file_r = (
-                    os.path.join(manga_folder, f"{nam_r}c.{ext_r}")
-                )
+            futures = {
+                executor.submit(worker, idx, page): (idx, 0)
+                for idx, page in pages.items()
+            }
+            # (due time, idx, attempt) of pages waiting out their backoff
+            retry_queue: list[tuple[float, str, int]] = []
+            failed = 0
+
+            while futures or retry_queue:
+                now = monotonic()
+                while retry_queue and retry_queue[0][0] <= now:
+                    _, idx, attempt = heappop(retry_queue)
+                    futures[executor.submit(worker, idx, pages[idx])] = (idx, attempt)
+
+                if not futures:
+                    # only pages waiting out their backoff are left
+                    sleep(retry_queue[0][0] - now)
+                    continue
 
-                shutil.move(im_l, destination_file_l)
-                shutil.move(im_r, destination_file_r)
-
-            if self.optimize == "pingo":
-                log.info("Optimizing images using pingo")
-                subprocess.call(
-                    [
-                        "pingo",
-                        "-lossless",
-                        "-nostrip",
-                        "-notime",
-                        manga_folder,
-                    ],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                )
-            elif self.optimize == "ect":
-                log.info("Optimizing images using ect")
-                subprocess.call(
-                    ["ect", "--mt-file", "--mt-deflate", "--strict", manga_folder],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                )
+                timeout = retry_queue[0][0] - now if retry_queue else None
 
-            if self.save_metadata != "none":
-                metd = OrderedDict()
-                sorted_d = sorted(metadata.items(), key=lambda x: x[0])
-                for sd in sorted_d:
-                    sdd = sd[1]
-                    if type(sdd) is list and len(sdd) == 1:
-                        sdd = sd[1][0]
-                    metd[sd[0]] = sdd
-
-                log.debug("Dumping metadata in info.json/ComicInfo.xml file")
-                json_info_file = os.path.join(
-                    manga_folder,
-                    "info.json",
+                done, _ = concurrent.futures.wait(
+                    futures,
+                    timeout=timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
                 )
-                with open(json_info_file, "w", encoding="utf-8") as f:
-                    json.dump(metd, f, indent=4, ensure_ascii=False)
+                for future in done:
+                    idx, attempt = futures.pop(future)
+                    try:
+                        future.result()
+                    except (curl_cffi.CurlError, OSError) as e:
+                        delay = self._retry_page(idx, attempt, e)
+                        if delay is None:
+                            failed += 1
+                        else:
+                            heappush(
+                                retry_queue, (monotonic() + delay, idx, attempt + 1)
+                            )
+                        continue
+                    pbar.update()
+                    if self.memory_budget is not None:
+                        pbar.set_postfix_str(self.memory_budget.progress())
 
-                log.debug("Dumping ComicInfo.xml")
-                comicinfo_file = os.path.join(manga_folder, "ComicInfo.xml")
-                with open(comicinfo_file, "wb") as f:
-                    f.write(self._build_comicinfo_xml(metd))
+        if failed:
+            log.error(
+                f"{failed} pages of {gallery.url} failed, "
+                "run again to download only the missing pages"
+            )
+            self._abort_archive(gallery)
+
+        return not failed
+
+    def _abort_archive(self, gallery: "Gallery"):
+        if gallery.archive is not None:
+            gallery.archive.abort()
+            gallery.archive = None
+
+    def _metadata_files(self, metadata: OrderedDict) -> list[tuple[str, bytes]]:
+        """info.json and ComicInfo.xml of a gallery, if metadata is saved."""
+        if self.save_metadata == "none":
+            return []
+
+        metd = OrderedDict()
+        sorted_d = sorted(metadata.items(), key=lambda x: x[0])
+        for sd in sorted_d:
+            sdd = sd[1]
+            if type(sdd) is list and len(sdd) == 1:
+                sdd = sd[1][0]
+            metd[sd[0]] = sdd
+
+        log.debug("Dumping metadata in info.json/ComicInfo.xml file")
+        info = json.dumps(metd, indent=4, ensure_ascii=False).encode("utf-8")
+
+        log.debug("Dumping ComicInfo.xml")
+        comicinfo = self._build_comicinfo_xml(metd)
+
+        return [("info.json", info), ("ComicInfo.xml", comicinfo)]
+
+    def _finish_gallery(self, gallery: "Gallery"):
+        """
+        Optimize pages, write metadata and archive a gallery
+        whose pages are all downloaded, then mark it done.
+        """
+        manga_folder = gallery.manga_folder
+        metadata = gallery.metadata
+
+        if gallery.archive is not None:
+            log.debug("Closing the cbz and deleting the image folder")
+            gallery.archive.close(self._metadata_files(metadata))
+            gallery.archive = None
+            shutil.rmtree(manga_folder)
+        else:
+            if self.optimizer is not None:
+                self.optimizer.wait(gallery.optimizing)
+
+            for name, data in self._metadata_files(metadata):
+                with open(os.path.join(manga_folder, name), "wb") as f:
+                    f.write(data)
 
             if self.zip:
                 log.debug("Creating a cbz and deleting the image folder after creation")
-                shutil.make_archive(manga_folder, "cbz", manga_folder)
+                assert self.archive_builder is not None
+                self.archive_builder.build_folder(manga_folder)
                 shutil.rmtree(manga_folder)
 
-            if not self.keep_response:
-                shutil.rmtree(response_folder)
+        if self.catalog is not None:
+            self._catalog_gallery(gallery)
+        gallery.manifest.remove()
+        if not self.keep_response:
+            shutil.rmtree(gallery.response_folder)
 
-            self.add_done_url(url)
-            urls_processed += 1
+        self.add_done_url(gallery.url)
+
+    def _catalog_gallery(self, gallery: "Gallery"):
+        assert self.catalog is not None
+        if self.zip:
+            path = f"{gallery.manga_folder}.cbz"
+            size = os.path.getsize(path)
+        else:
+            path = gallery.manga_folder
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+        self.catalog.add(
+            entry_from_metadata(
+                path, gallery.metadata, len(gallery.api_data["pages"]), size
+            )
+        )
 
-            log.debug("Finished parsing page")
-            sleep(self.wait)
+    def _make_root_dirs(self):
+        if not os.path.exists(self.root_manga_dir):
+            os.mkdir(self.root_manga_dir)
+        if not os.path.exists(self.root_response_dir):
+            os.mkdir(self.root_response_dir)
 
+    def _finish_run(self, urls_processed: int):
         log.info(f"Urls processed: {urls_processed}")
+        stats = permutation_cache.stats()
+        log.info(
+            "Permutation cache: %d hits, %d disk hits, %d misses",
+            stats["hits"],
+            stats["disk_hits"],
+            stats["misses"],
+        )
+        permutation_cache.close()
+        if self.http_cache is not None:
+            stats = self.http_cache.stats()
+            log.info(
+                "HTTP cache: %d hits, %d revalidated, %d misses",
+                stats["hits"],
+                stats["revalidated"],
+                stats["misses"],
+            )
+            self.http_cache.close()
+        self.encode_stats.log()
+        if self.proxy_pool is not None:
+            self.proxy_pool.log()
+        if self.descramble_pool is not None:
+            self.descramble_pool.shutdown()
+        if self.archive_builder is not None:
+            self.archive_builder.shutdown()
+        if self.optimizer is not None:
+            self.optimizer.log()
+            self.optimizer.shutdown()
+        if self.memory_budget is not None:
+            self.memory_budget.log()
+        if self.page_store is not None:
+            self.page_store.log()
+            self.page_store.close()
+        if self.url_store is not None:
+            self.url_store.log()
+            self.url_store.close()
+        if self.catalog is not None:
+            self.catalog.log()
+            self.catalog.close()
         self.cookie_jar.save()
+
+    def _iter_galleries(self, executor: ThreadPoolExecutor | None):
+        """
+        Yield the fetched gallery (or None if skipped) for every url in order,
+        fetching up to lookahead galleries ahead on executor.
+        """
+        if executor is None:
+            for url in self.urls:
+                yield self._fetch_tracked(url)
+            return
+
+        pending: deque[Future] = deque()
+        for url in self.urls:
+            pending.append(executor.submit(self._fetch_tracked, url))
+            if len(pending) > self.lookahead:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    def _is_started(self, gallery: "Gallery", started: set[str]) -> bool:
+        """
+        Catch galleries redirecting to one downloaded earlier in this run,
+        which a prefetched gallery page could not see in the done file yet.
+        Chapters are added to started once their pages are all downloaded.
+        """
+        if gallery.chapter_url in started:
+            log.info("URL redirects to a done hentai: %s", gallery.chapter_url)
+            self.add_done_url(gallery.url)
+            return True
+
+        return False
+
+    def _gallery_delay(self) -> float:
+        if self.controller is None:
+            return self.wait
+
+        self.controller.log()
+        return self.controller.delay
+
+    def load_all(self):
+        log.debug("Starting main downloader function")
+
+        self._make_root_dirs()
+
+        urls_processed = 0
+        started: set[str] = set()
+        finishing: Future | None = None
+
+        with (
+            ThreadPoolExecutor(max_workers=max(1, self.lookahead)) as prefetcher,
+            ThreadPoolExecutor(max_workers=1) as finisher,
+        ):
+            for gallery in self._iter_galleries(
+                prefetcher if self.lookahead > 0 else None
+            ):
+                urls_processed += 1
+                if gallery is None or self._is_started(gallery, started):
+                    continue
+
+                if not self._download_pages(gallery):
+                    self._url_failed(gallery.url, "pages missing")
+                    continue
+                started.add(gallery.chapter_url)
+
+                # Spreads, optimizing and archiving run while the next
+                # gallery downloads, one gallery at a time.
+                if finishing is not None:
+                    finishing.result()
+                finishing = finisher.submit(self._finish_gallery, gallery)
+
+                log.debug("Finished parsing page")
+                sleep(self._gallery_delay())
+
+            if finishing is not None:
+                finishing.result()
+
+        self._finish_run(urls_processed)
+
+
+@dataclass
+class Gallery:
+    """A gallery whose metadata and keys are fetched, ready for its pages."""
+
+    url: str
+    chapter_id: str
+    metadata: OrderedDict
+    api_data: dict
+    keys: Mapping[str, list[int]]
+    manga_folder: str
+    response_folder: str
+    direction: str
+    padd: int
+    spreads: dict[str, tuple[str, str]]
+    manifest: PageManifest
+    joiner: SpreadJoiner
+    archive: PageArchive | None = None
+    # Pages being optimized
+    optimizing: list[Future] = field(default_factory=list)
+
+    @property
+    def chapter_url(self) -> str:
+        return f"https://www.fakku.net/hentai/{self.chapter_id}"
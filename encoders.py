@@ -0,0 +1,101 @@
+import logging
+import threading
+from io import BytesIO
+from time import perf_counter
+from typing import BinaryIO
+
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+
+def encode_png(image: Image.Image, fp: BinaryIO, compress_level: int | None = None):
+    """
+    Lossless PNG. Without a compress_level Pillow's slow optimize pass is used.
+    """
+    if compress_level is None:
+        image.save(fp, "PNG", optimize=True)
+    else:
+        image.save(fp, "PNG", compress_level=compress_level)
+
+
+def encode_webp(image: Image.Image, fp: BinaryIO, compress_level: int | None = None):
+    """
+    Lossless WebP. compress_level is the encoder method, 0 (fast) to 6 (small).
+    """
+    if compress_level is None:
+        compress_level = 4
+    image.save(
+        fp,
+        "WEBP",
+        lossless=True,
+        quality=100,
+        method=max(0, min(6, compress_level)),
+    )
+
+
+PAGE_ENCODERS = {
+    "png": encode_png,
+    "webp": encode_webp,
+}
+
+
+def encode_page(
+    image: Image.Image, page_format: str, compress_level: int | None = None
+) -> tuple[bytes, str, float]:
+    """
+    Encode a descrambled page.
+    --------------------------
+    return: (data, ext, seconds) -- tuple
+        Encoded bytes, their file extension and the time spent encoding
+    """
+    out_bytes = BytesIO()
+    ext, encode_time = write_page(image, out_bytes, page_format, compress_level)
+    return out_bytes.getvalue(), ext, encode_time
+
+
+def write_page(
+    image: Image.Image,
+    fp: BinaryIO,
+    page_format: str,
+    compress_level: int | None = None,
+) -> tuple[str, float]:
+    """
+    Encode a descrambled page straight into a file object.
+    --------------------------
+    return: (ext, seconds) -- tuple
+        File extension of the encoded page and the time spent encoding
+    """
+    start = perf_counter()
+    PAGE_ENCODERS[page_format](image, fp, compress_level)
+    return page_format, perf_counter() - start
+
+
+class EncodeStats:
+    """
+    Thread-safe per-encoder totals of pages, encode time and output size.
+    Pages saved as they came from the server are counted under "raw".
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: dict[str, list[float]] = {}
+
+    def add(self, encoder: str, seconds: float, size: int):
+        with self._lock:
+            totals = self._totals.setdefault(encoder, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += size
+
+    def log(self):
+        with self._lock:
+            for encoder, (pages, seconds, size) in sorted(self._totals.items()):
+                log.info(
+                    "Encoder %s: %d pages, %.1f MiB, %.2f s (%.1f ms/page)",
+                    encoder,
+                    pages,
+                    size / 2**20,
+                    seconds,
+                    1000 * seconds / pages,
+                )
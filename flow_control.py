@@ -0,0 +1,356 @@
+import asyncio
+import logging
+import random
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from time import monotonic
+from urllib.parse import urlsplit
+
+log = logging.getLogger(__name__)
+
+
+def is_congestion_status(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+def backoff_delay(attempt: int, base: float, cap: float = 60.0) -> float:
+    """
+    Exponential backoff with jitter: up to base * 2**attempt seconds, capped,
+    and at least half of that.
+    """
+    delay = min(cap, base * 2**attempt)
+    return random.uniform(delay / 2, delay)
+
+
+class AIMDController:
+    """
+    Additive-increase/multiplicative-decrease limit on requests in flight.
+
+    Every healthy response grows the window by increase / window, so it grows
+    by about `increase` per window's worth of requests, as long as latency
+    stays within latency_factor of the best seen. A 429, 5xx or failed
+    request multiplies it by decrease, at most once per cooldown so a burst of
+    errors from the same window only counts once. The pause between galleries
+    scales inversely with the window, starting at wait.
+    """
+
+    def __init__(
+        self,
+        initial: int = 5,
+        minimum: int = 1,
+        maximum: int = 32,
+        wait: float = 0.1,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_factor: float = 3.0,
+        max_delay: float = 60.0,
+    ):
+        self.window = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.max_delay = max_delay
+
+        self._initial = initial
+        self._wait = wait
+        self._latency: float | None = None
+        self._base_latency: float | None = None
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._congestions = 0
+
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_condition: asyncio.Condition | None = None
+
+    @property
+    def limit(self) -> int:
+        return max(self.minimum, int(self.window))
+
+    @property
+    def delay(self) -> float:
+        """Pause between galleries for the current window."""
+        return min(self.max_delay, self._wait * self._initial / self.window)
+
+    def record(self, latency: float | None, congested: bool = False):
+        """
+        Feed the outcome of a request: its latency in seconds, and whether
+        the server pushed back or the request failed.
+        """
+        with self._condition:
+            if congested:
+                self._congestions += 1
+                now = monotonic()
+                cooldown = max(1.0, 2 * (self._latency or 0.0))
+                if now - self._last_decrease >= cooldown:
+                    self._last_decrease = now
+                    self.window = max(self.minimum, self.window * self.decrease)
+                    log.debug(
+                        f"Congestion, concurrency window cut to {self.window:.1f}"
+                    )
+                return
+
+            if latency is None:
+                return
+
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency = 0.8 * self._latency + 0.2 * latency
+            if self._base_latency is None or latency < self._base_latency:
+                self._base_latency = latency
+
+            if self._latency <= self._base_latency * self.latency_factor:
+                self.window = min(
+                    self.maximum, self.window + self.increase / self.window
+                )
+                self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the window's request slots, for threads."""
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        """Hold one of the window's request slots, for asyncio tasks."""
+        if self._async_condition is None:
+            self._async_condition = asyncio.Condition()
+        condition = self._async_condition
+
+        async with condition:
+            await condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            async with condition:
+                self._in_flight -= 1
+                condition.notify_all()
+
+    def log(self):
+        log.info(
+            "Concurrency window: %.1f requests, %d congestion signals, "
+            "latency %.0f ms, next gallery in %.2f s",
+            self.window,
+            self._congestions,
+            1000 * (self._latency or 0.0),
+            self.delay,
+        )
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate tokens per second, holding at most burst.
+
+    reserve() always takes its tokens, running the bucket into debt, and
+    returns how long the caller has to wait for them, so waiters are served
+    in the order they reserved.
+    """
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    Requests per second and bytes per second buckets per host, shared by
+    every worker.
+
+    A request waits for its request token and for the byte bucket to be out
+    of debt, then charges the size of its response to the byte bucket once
+    it is known. Hosts missing from the limits use the "*" entry if there is
+    one, otherwise they are not limited.
+    """
+
+    def __init__(
+        self,
+        request_rates: dict[str, float] | None = None,
+        byte_rates: dict[str, float] | None = None,
+    ):
+        self.request_rates = request_rates or {}
+        self.byte_rates = byte_rates or {}
+        self._buckets: dict[tuple[str, str], TokenBucket | None] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, kind: str, host: str) -> TokenBucket | None:
+        key = (kind, host)
+        with self._lock:
+            if key not in self._buckets:
+                rates = self.request_rates if kind == "requests" else self.byte_rates
+                rate = rates.get(host, rates.get("*"))
+                # a second's worth of burst for bytes, one request for requests
+                self._buckets[key] = (
+                    None
+                    if rate is None
+                    else TokenBucket(rate, rate if kind == "bytes" else 1.0)
+                )
+            return self._buckets[key]
+
+    def delay(self, url: str) -> float:
+        """Seconds to wait before sending a request to url."""
+        host = urlsplit(url).hostname or ""
+        delay = 0.0
+
+        requests = self._bucket("requests", host)
+        if requests is not None:
+            delay = requests.reserve()
+
+        transfer = self._bucket("bytes", host)
+        if transfer is not None:
+            delay = max(delay, transfer.reserve(0))
+
+        return delay
+
+    def charge(self, url: str, nbytes: int):
+        """Count the nbytes of a response from url."""
+        transfer = self._bucket("bytes", urlsplit(url).hostname or "")
+        if transfer is not None:
+            transfer.reserve(nbytes)
+
+
+class MemoryReservation:
+    """
+    What one page holds of a MemoryBudget: an estimate until the page
+    charges what it actually holds.
+    """
+
+    def __init__(self, estimate: int):
+        self.estimate = estimate
+        self.charged = 0
+
+    @property
+    def held(self) -> int:
+        return self.charged or self.estimate
+
+
+class MemoryBudget:
+    """
+    Ceiling on the bytes pages hold in flight: responses, decoded images and
+    encoded output.
+
+    A page reserves an estimate before it is fetched, the average of the
+    pages before it, and charges what it actually holds once its response
+    is in, until it is saved. New pages are not fetched while the budget is
+    used up, except when none is in flight, so a page bigger than the limit
+    still goes through on its own. Until a page is measured the estimate is
+    the whole limit, so the first page goes alone.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.waits = 0
+
+        self._pages = 0
+        self._average: float | None = None
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_condition: asyncio.Condition | None = None
+
+    def _estimate(self) -> int:
+        return self.limit if self._average is None else int(self._average)
+
+    def _has_room(self) -> bool:
+        return self._pages == 0 or self.used + self._estimate() <= self.limit
+
+    def _reserve(self) -> MemoryReservation:
+        reservation = MemoryReservation(self._estimate())
+        self._pages += 1
+        self.used += reservation.held
+        return reservation
+
+    def _charge(self, reservation: MemoryReservation, nbytes: int):
+        self.used += nbytes - reservation.held
+        reservation.charged = nbytes
+        self.peak = max(self.peak, self.used)
+        if self._average is None:
+            self._average = float(nbytes)
+        else:
+            self._average = 0.8 * self._average + 0.2 * nbytes
+
+    def _release(self, reservation: MemoryReservation):
+        self.used -= reservation.held
+        self._pages -= 1
+
+    @contextmanager
+    def reserve(self):
+        """Wait for room for one more page, for threads."""
+        with self._condition:
+            if not self._has_room():
+                self.waits += 1
+                self._condition.wait_for(self._has_room)
+            reservation = self._reserve()
+        try:
+            yield reservation
+        finally:
+            with self._condition:
+                self._release(reservation)
+                self._condition.notify_all()
+
+    def charge(self, reservation: MemoryReservation, nbytes: int):
+        with self._condition:
+            self._charge(reservation, nbytes)
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def async_reserve(self):
+        """Wait for room for one more page, for asyncio tasks."""
+        if self._async_condition is None:
+            self._async_condition = asyncio.Condition()
+        condition = self._async_condition
+
+        async with condition:
+            if not self._has_room():
+                self.waits += 1
+                await condition.wait_for(self._has_room)
+            reservation = self._reserve()
+        try:
+            yield reservation
+        finally:
+            async with condition:
+                self._release(reservation)
+                condition.notify_all()
+
+    async def async_charge(self, reservation: MemoryReservation, nbytes: int):
+        assert self._async_condition is not None
+        async with self._async_condition:
+            self._charge(reservation, nbytes)
+            self._async_condition.notify_all()
+
+    def progress(self) -> str:
+        return f"{self.used / 2**20:.0f}/{self.limit / 2**20:.0f} MiB"
+
+    def log(self):
+        log.info(
+            "Page memory: peak %.0f MiB of %.0f MiB, %d fetches held back",
+            self.peak / 2**20,
+            self.limit / 2**20,
+            self.waits,
+        )
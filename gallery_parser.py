@@ -0,0 +1,167 @@
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple
+
+import lxml.etree
+import lxml.html
+from bs4 import BeautifulSoup
+
+log = logging.getLogger(__name__)
+
+# Rows the API has better data for
+SKIPPED_ROWS = [
+    "Artist",
+    "Parody",
+    "Publisher",
+    "Language",
+    "Pages",
+    "Direction",
+]
+
+
+def _add_row(
+    metadata: OrderedDict, left_text: str, link_texts: list[str], right_text: str
+):
+    if link_texts:
+        metadata[left_text] = [text.strip() for text in link_texts if text != "+"]
+    elif left_text in ["Favorites"]:
+        metadata[left_text] = int("".join(right_text.strip().split(" ")[0].split(",")))
+    else:
+        metadata[left_text] = right_text.strip()
+
+
+def parse_bs4(content: bytes, encoding: str = "utf-8") -> BeautifulSoup:
+    return BeautifulSoup(content.decode(encoding, errors="replace"), "lxml")
+
+
+def bs4_reader_href(doc: BeautifulSoup) -> str | None:
+    for elem in doc.select('a[class^="button-green"]'):
+        if "Start Reading" in elem.text:
+            href = elem.get("href")
+            if isinstance(href, str):
+                return href
+
+    return None
+
+
+def bs4_page_metadata(doc: BeautifulSoup) -> OrderedDict:
+    metadata = OrderedDict()
+
+    log.debug("Parsing right side for metadata")
+
+    meta_rows = doc.select(
+        'div[class^="block md:table-cell relative w-full align-top"] div[class^="table text-sm w-full"]'
+    )
+
+    log.debug("Parsing right side rows")
+    for row in meta_rows:
+        meta_row_left = row.select_one(
+            'div[class^="inline-block w-24 text-left align-top"]'
+        )
+        left_text = meta_row_left.text.strip() if meta_row_left is not None else ""
+
+        if not left_text or left_text in SKIPPED_ROWS:
+            continue
+
+        log.debug(f"Parsing {left_text}")
+        meta_row_right = row.select_one(
+            'div[class^="table-cell w-full align-top text-left"]'
+        )
+        if meta_row_right is not None:
+            _add_row(
+                metadata,
+                left_text,
+                [a_tag.text for a_tag in meta_row_right.select("a")],
+                meta_row_right.text,
+            )
+
+    log.debug("Parsing left side for metadata")
+    price_elem = doc.select_one(
+        'div[class^="block sm:inline-block relative w-full align-top"] div[class^="rounded cursor-pointer right"] div[class^="table w-auto text-right opacity-90 hover:opacity-100 js-purchase-product"] div'
+    )
+    if price_elem is not None:
+        price = float(price_elem.text[1:])
+        metadata["Price"] = price
+
+    return metadata
+
+
+def _class_starts_with(prefix: str) -> str:
+    # soupsieve matches ^= against the class list joined by single spaces
+    return f'starts-with(normalize-space(@class), "{prefix}")'
+
+
+_GREEN_BUTTONS = lxml.etree.XPath(f"//a[{_class_starts_with('button-green')}]")
+_META_ROWS = lxml.etree.XPath(
+    f"//div[{_class_starts_with('block md:table-cell relative w-full align-top')}]"
+    f"//div[{_class_starts_with('table text-sm w-full')}]"
+)
+_ROW_LEFT = lxml.etree.XPath(
+    f"(.//div[{_class_starts_with('inline-block w-24 text-left align-top')}])[1]"
+)
+_ROW_RIGHT = lxml.etree.XPath(
+    f"(.//div[{_class_starts_with('table-cell w-full align-top text-left')}])[1]"
+)
+_LINKS = lxml.etree.XPath(".//a")
+_PRICE = lxml.etree.XPath(
+    f"(//div[{_class_starts_with('block sm:inline-block relative w-full align-top')}]"
+    f"//div[{_class_starts_with('rounded cursor-pointer right')}]"
+    f"//div[{_class_starts_with('table w-auto text-right opacity-90 hover:opacity-100 js-purchase-product')}]"
+    "//div)[1]"
+)
+_TEXT = lxml.etree.XPath("string()")
+
+
+def parse_lxml(content: bytes, encoding: str = "utf-8") -> lxml.html.HtmlElement:
+    if not content.strip():
+        # lxml refuses empty documents, BeautifulSoup gives an empty tree
+        content = b"<html></html>"
+    return lxml.html.document_fromstring(
+        content, parser=lxml.html.HTMLParser(encoding=encoding)
+    )
+
+
+def lxml_reader_href(doc: lxml.html.HtmlElement) -> str | None:
+    for elem in _GREEN_BUTTONS(doc):
+        if "Start Reading" in _TEXT(elem):
+            return elem.get("href")
+
+    return None
+
+
+def lxml_page_metadata(doc: lxml.html.HtmlElement) -> OrderedDict:
+    metadata = OrderedDict()
+
+    for row in _META_ROWS(doc):
+        meta_row_left = _ROW_LEFT(row)
+        left_text = _TEXT(meta_row_left[0]).strip() if meta_row_left else ""
+
+        if not left_text or left_text in SKIPPED_ROWS:
+            continue
+
+        meta_row_right = _ROW_RIGHT(row)
+        if meta_row_right:
+            _add_row(
+                metadata,
+                left_text,
+                [_TEXT(a_tag) for a_tag in _LINKS(meta_row_right[0])],
+                _TEXT(meta_row_right[0]),
+            )
+
+    price_elem = _PRICE(doc)
+    if price_elem:
+        metadata["Price"] = float(_TEXT(price_elem[0])[1:])
+
+    return metadata
+
+
+class GalleryParser(NamedTuple):
+    parse: Callable[[bytes, str], Any]
+    reader_href: Callable[[Any], str | None]
+    page_metadata: Callable[[Any], OrderedDict]
+
+
+GALLERY_PARSERS = {
+    "bs4": GalleryParser(parse_bs4, bs4_reader_href, bs4_page_metadata),
+    "lxml": GalleryParser(parse_lxml, lxml_reader_href, lxml_page_metadata),
+}
@@ -0,0 +1,180 @@
+import json
+import logging
+import sqlite3
+import threading
+from time import time
+
+log = logging.getLogger(__name__)
+
+
+class CachedResponse:
+    """The parts of a response the gallery parsers use, replayed from cache."""
+
+    def __init__(self, url: str, content: bytes, headers: dict, encoding: str):
+        self.url = url
+        self.status_code = 200
+        self.content = content
+        self.headers = headers
+        self.encoding = encoding
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class ResponseCache:
+    """
+    sqlite cache of gallery HTML and reader API responses.
+
+    Entries younger than ttl seconds are served without a request. Older ones
+    are revalidated with If-None-Match/If-Modified-Since, so an unchanged page
+    costs a 304. Once the bodies add up to more than max_size bytes the least
+    recently used entries are evicted.
+
+    Entries are kept per session: the reader API encrypts page keys for the
+    session's fakku_zid and the /read page depends on the account, so a
+    response is only replayed to the session it was fetched by.
+    """
+
+    def __init__(self, path: str, ttl: float = 300.0, max_size: int = 64 * 2**20):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        log.debug(f"Opening HTTP cache {path}")
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            # entries of caches from before they were kept per session
+            "DROP TABLE IF EXISTS responses;"
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, body BLOB NOT NULL, headers TEXT NOT NULL, "
+            "encoding TEXT NOT NULL, stored REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def lookup(
+        self, url: str, session: str = ""
+    ) -> tuple[CachedResponse | None, dict[str, str]]:
+        """
+        Look up a url before requesting it.
+        --------------------------
+        param: session -- str
+            Identity of the session requesting it
+        return: (response, headers) -- tuple
+            The cached response if it is fresh, otherwise None and the
+            conditional headers to send, empty if nothing is cached
+        """
+        key = f"{session} {url}"
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, headers, encoding, stored FROM entries WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None, {}
+
+            body, headers, encoding, stored = row
+            headers = json.loads(headers)
+            if time() - stored < self.ttl:
+                self.hits += 1
+                self._db.execute(
+                    "UPDATE entries SET used = ? WHERE key = ?", (time(), key)
+                )
+                self._db.commit()
+                return CachedResponse(url, body, headers, encoding), {}
+
+        conditional = {}
+        if "etag" in headers:
+            conditional["if-none-match"] = headers["etag"]
+        if "last-modified" in headers:
+            conditional["if-modified-since"] = headers["last-modified"]
+
+        return None, conditional
+
+    def update(self, url: str, resp, session: str = ""):
+        """
+        Store a fresh 200 response, or renew the cached one on a 304.
+        --------------------------
+        return: resp -- response
+            What the caller should use in place of resp
+        """
+        now = time()
+        key = f"{session} {url}"
+
+        if resp.status_code == 304:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT body, headers, encoding FROM entries WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is None:
+                    return resp
+                self.revalidated += 1
+                self._db.execute(
+                    "UPDATE entries SET stored = ?, used = ? WHERE key = ?",
+                    (now, now, key),
+                )
+                self._db.commit()
+            body, headers, encoding = row
+            return CachedResponse(url, body, json.loads(headers), encoding)
+
+        if resp.status_code != 200:
+            return resp
+
+        validators = {
+            name: resp.headers[name]
+            for name in ("etag", "last-modified")
+            if resp.headers.get(name)
+        }
+        with self._lock:
+            self.misses += 1
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    resp.content,
+                    json.dumps(validators),
+                    resp.encoding or "utf-8",
+                    now,
+                    now,
+                ),
+            )
+            self._evict()
+            self._db.commit()
+
+        return resp
+
+    def _evict(self):
+        total = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM entries"
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        for key, size in self._db.execute(
+            "SELECT key, LENGTH(body) FROM entries ORDER BY used"
+        ).fetchall():
+            if total <= self.max_size:
+                break
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+        }
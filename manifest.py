@@ -0,0 +1,78 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PageManifest:
+    """
+    Record of the finished pages of a gallery, so an interrupted download
+    resumes from the pages still missing.
+
+    Every finished page appends one JSON line with its index, its file name
+    relative to the gallery folder and the sha256 of the file, so a crash can
+    lose at most the line being written. On load a page only counts as
+    finished if its file is still there with the same checksum.
+    """
+
+    def __init__(self, path: str, folder: str):
+        self.path = path
+        self.folder = folder
+        self._lock = threading.Lock()
+
+    def load(self) -> dict[str, str]:
+        """
+        Read back the finished pages.
+        --------------------------
+        return: pages -- dict
+            Page index to the path of its intact file
+        """
+        entries: dict[str, dict] = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # torn last line of an interrupted run
+                        continue
+                    entries[entry["idx"]] = entry
+        except FileNotFoundError:
+            return {}
+
+        pages = {}
+        for idx, entry in entries.items():
+            path = os.path.join(self.folder, entry["file"])
+            if os.path.isfile(path) and file_sha256(path) == entry["sha256"]:
+                pages[idx] = path
+            else:
+                log.debug(f"Page {idx} changed since it was downloaded, refetching")
+
+        return pages
+
+    def add(self, idx: str, path: str):
+        line = json.dumps(
+            {
+                "idx": idx,
+                "file": os.path.relpath(path, self.folder),
+                "sha256": file_sha256(path),
+            }
+        )
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,124 @@
+import concurrent.futures
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import perf_counter
+
+log = logging.getLogger(__name__)
+
+# Lossless single-file invocations, one process per page
+OPTIMIZER_COMMANDS = {
+    "pingo": ["pingo", "-lossless", "-nostrip", "-notime"],
+    "ect": ["ect", "--strict"],
+}
+
+
+class PageOptimizer:
+    """
+    Optimizes pages with pingo/ect while the rest of the gallery downloads.
+
+    Each page is optimized as a copy by its own optimizer process, at most
+    workers at a time. The copy replaces the page only if the optimizer
+    finished within timeout seconds and made it smaller, so a page that
+    takes too long is kept as it was downloaded.
+    """
+
+    def __init__(self, tool: str, workers: int | None = None, timeout: float = 60.0):
+        self.tool = tool
+        self.command = OPTIMIZER_COMMANDS[tool]
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(workers or os.cpu_count())
+
+        self.pages = 0
+        self.timed_out = 0
+        self.saved = 0
+        self.seconds = 0.0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def submit(
+        self, path: str, tmp_dir: str, done: Callable[[], None] | None = None
+    ) -> Future:
+        """
+        Queue a page for optimizing.
+        --------------------------
+        param: tmp_dir -- string
+            Folder for the copy being optimized
+        param: done -- function
+            Called after the page is replaced by its optimized copy
+        """
+        return self.pool.submit(self._optimize, path, tmp_dir, done)
+
+    def _optimize(self, path: str, tmp_dir: str, done: Callable[[], None] | None):
+        # the optimizers tell formats apart by extension
+        fd, tmp = tempfile.mkstemp(suffix=os.path.splitext(path)[1], dir=tmp_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(path, tmp)
+            start = perf_counter()
+            try:
+                subprocess.run(
+                    self.command + [tmp],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=self.timeout,
+                )
+            except subprocess.TimeoutExpired:
+                log.debug(f"Optimizing {path} timed out, keeping it as it is")
+                with self._lock:
+                    self.timed_out += 1
+                    self.seconds += perf_counter() - start
+                return
+            seconds = perf_counter() - start
+
+            before = os.path.getsize(path)
+            after = os.path.getsize(tmp)
+            log.debug(f"Optimized {path}: {before} -> {after} bytes in {seconds:.2f}s")
+            with self._lock:
+                self.pages += 1
+                self.seconds += seconds
+                if 0 < after < before:
+                    self.saved += before - after
+
+            if 0 < after < before:
+                # mkstemp made the copy private, give it the mode of the page
+                shutil.copymode(path, tmp)
+                shutil.move(tmp, path)
+                if done is not None:
+                    done()
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def wait(self, futures: list[Future]):
+        """Wait for the pages of a gallery, counting the time it holds it up."""
+        start = perf_counter()
+        for future in concurrent.futures.as_completed(futures):
+            error = future.exception()
+            if error is not None:
+                log.warning(f"Failed to optimize a page: {error}")
+        with self._lock:
+            self.waited += perf_counter() - start
+
+    def log(self):
+        if not self.pages and not self.timed_out:
+            return
+        log.info(
+            "Optimized %d pages with %s: %.1f MiB saved, %.2fs per page, "
+            "%.1fs of %.1fs while downloading, %d timed out",
+            self.pages,
+            self.tool,
+            self.saved / 2**20,
+            self.seconds / max(self.pages + self.timed_out, 1),
+            max(self.seconds - self.waited, 0.0),
+            self.seconds,
+            self.timed_out,
+        )
+
+    def shutdown(self):
+        self.pool.shutdown()
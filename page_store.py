@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+
+def image_digest(
+    image: Image.Image, page_format: str, compress_level: int | None
+) -> str:
+    """Key of a descrambled page: its pixels and the settings it is encoded with."""
+    digest = hashlib.sha256(
+        f"{image.mode} {image.size} {page_format} {compress_level}\n".encode()
+    )
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def data_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_path(root: str, digest: str, ext: str) -> str:
+    return os.path.join(root, digest[:2], f"{digest}.{ext}")
+
+
+def detach_file(path: str):
+    """
+    Remove a file about to be written again, as it may be hardlinked with
+    the page store and other galleries, which writing it in place would
+    change too.
+    """
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def link_file(src: str, dest: str):
+    """Hardlink src to dest, or copy it where hardlinks are not possible."""
+    detach_file(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class PageStore:
+    """
+    Content-addressed store of pages, shared by all galleries.
+
+    Descrambled pages are filed under the sha256 of their pixels and encode
+    settings, everything else under the sha256 of its bytes. A page already
+    in the store is hardlinked into the gallery instead of being encoded and
+    written again. The store keeps a link to every page it has seen, so it
+    still holds them after their gallery is archived. An sqlite index keeps
+    the encode time of each page to report what was saved. A page optimized
+    after it was stored takes the place of its stored copy, so later
+    galleries are linked to the optimized file.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.hits = 0
+        self.bytes_saved = 0
+        self.encode_saved = 0.0
+        self.optimized = 0
+
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(root, "index.db"), check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pages "
+            "(digest TEXT PRIMARY KEY, encode_time REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def find(self, digest: str, ext: str) -> str | None:
+        path = store_path(self.root, digest, ext)
+        return path if os.path.exists(path) else None
+
+    def _record(self, digest: str, encode_time: float):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO pages VALUES (?, ?)", (digest, encode_time)
+            )
+            self._db.commit()
+
+    def add_data(self, digest: str, ext: str, data: bytes, encode_time: float) -> str:
+        """Store a page unless it is there already, returns its path in the store."""
+        path = store_path(self.root, digest, ext)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # opened normally so the page gets the umask's mode, as it is
+            # linked into galleries
+            tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.part"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._record(digest, encode_time)
+        return path
+
+    def add_file(self, digest: str, path: str, encode_time: float):
+        """Link a page written outside the store into it."""
+        stored = store_path(self.root, digest, os.path.splitext(path)[1][1:])
+        if os.path.exists(stored):
+            return
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        try:
+            os.link(path, stored)
+        except FileExistsError:
+            return
+        except OSError:
+            shutil.copyfile(path, stored)
+        self._record(digest, encode_time)
+
+    def replace_file(self, digest: str, path: str):
+        """Store a new file of a stored page in place of the old one."""
+        stored = store_path(self.root, digest, os.path.splitext(path)[1][1:])
+        if os.path.exists(stored) and os.path.samefile(stored, path):
+            return
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        tmp = f"{stored}.{os.getpid()}-{threading.get_ident()}.part"
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, stored)
+        with self._lock:
+            self.optimized += 1
+
+    def hit(self, digest: str, path: str):
+        """Count a page taken from the store."""
+        size = os.path.getsize(path)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT encode_time FROM pages WHERE digest = ?", (digest,)
+            ).fetchone()
+            self.hits += 1
+            self.bytes_saved += size
+            if row is not None:
+                self.encode_saved += row[0]
+
+    def dedupe_file(self, path: str) -> str:
+        """
+        Swap a written file for a link to its copy in the store, if any,
+        and store it otherwise. Returns its digest.
+        """
+        digest = file_digest(path)
+        stored = self.find(digest, os.path.splitext(path)[1][1:])
+        if stored is None:
+            self.add_file(digest, path, 0.0)
+        elif not os.path.samefile(stored, path):
+            link_file(stored, path)
+            self.hit(digest, path)
+        return digest
+
+    def log(self):
+        log.info(
+            "Page store: %d pages deduplicated, %.1f MiB and %.1fs of encoding "
+            "saved, %d replaced by their optimized copy",
+            self.hits,
+            self.bytes_saved / 2**20,
+            self.encode_saved,
+            self.optimized,
+        )
@@ -0,0 +1,126 @@
+import logging
+import random
+import threading
+from time import monotonic
+from urllib.parse import urlsplit
+
+log = logging.getLogger(__name__)
+
+
+def redact(url: str) -> str:
+    """Proxy url without its credentials, for logs."""
+    parts = urlsplit(url)
+    if parts.password is None and parts.username is None:
+        return url
+    return parts._replace(netloc=parts.netloc.rpartition("@")[2]).geturl()
+
+
+class ProxyStats:
+    """Health of one proxy, smoothed over its recent requests."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.throughput: float | None = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+
+class ProxyPool:
+    """
+    Spreads requests over proxies, weighted by throughput and error rate.
+
+    Each request is routed to a healthy proxy picked at random with weight
+    throughput * (1 - error_rate)**2, so fast reliable proxies take most of
+    the load while the others keep being measured. A proxy that fails
+    max_failures times in a row, or whose error rate goes over max_error_rate,
+    is ejected for a cooldown that doubles every time it happens again.
+    """
+
+    def __init__(
+        self,
+        urls: list[str],
+        smoothing: float = 0.2,
+        max_failures: int = 3,
+        max_error_rate: float = 0.5,
+        cooldown: float = 30.0,
+        max_cooldown: float = 600.0,
+    ):
+        self.proxies = [ProxyStats(url) for url in urls]
+        self.smoothing = smoothing
+        self.max_failures = max_failures
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self._lock = threading.Lock()
+
+    def _weight(self, proxy: ProxyStats, default_throughput: float) -> float:
+        throughput = proxy.throughput or default_throughput
+        return throughput * (1.0 - proxy.error_rate) ** 2 + 1e-9
+
+    def choose(self) -> str:
+        """Proxy url to send the next request through."""
+        with self._lock:
+            now = monotonic()
+            healthy = [p for p in self.proxies if p.ejected_until <= now]
+            if not healthy:
+                # all ejected: use the one closest to coming back
+                return min(self.proxies, key=lambda p: p.ejected_until).url
+
+            # untried proxies get the average, so they are tried soon
+            measured = [p.throughput for p in healthy if p.throughput]
+            default = sum(measured) / len(measured) if measured else 1.0
+
+            weights = [self._weight(p, default) for p in healthy]
+            return random.choices(healthy, weights)[0].url
+
+    def record(self, url: str, nbytes: int, seconds: float, failed: bool = False):
+        """Feed the outcome of a request sent through the proxy url."""
+        with self._lock:
+            proxy = next(p for p in self.proxies if p.url == url)
+            alpha = self.smoothing
+
+            proxy.requests += 1
+            proxy.error_rate = (1 - alpha) * proxy.error_rate + alpha * failed
+
+            if failed:
+                proxy.failures += 1
+                proxy.consecutive_failures += 1
+                if proxy.ejected_until <= monotonic() and (
+                    proxy.consecutive_failures >= self.max_failures
+                    or proxy.error_rate > self.max_error_rate
+                ):
+                    self._eject(proxy)
+                return
+
+            proxy.consecutive_failures = 0
+            throughput = nbytes / max(seconds, 1e-3)
+            if proxy.throughput is None:
+                proxy.throughput = throughput
+            else:
+                proxy.throughput = (1 - alpha) * proxy.throughput + alpha * throughput
+
+    def _eject(self, proxy: ProxyStats):
+        cooldown = min(self.max_cooldown, self.cooldown * 2**proxy.ejections)
+        proxy.ejections += 1
+        proxy.ejected_until = monotonic() + cooldown
+        # back on probation after the cooldown
+        proxy.consecutive_failures = 0
+        proxy.error_rate = self.max_error_rate / 2
+        log.warning(f"Ejecting proxy {redact(proxy.url)} for {cooldown:.0f}s")
+
+    def log(self):
+        with self._lock:
+            for proxy in self.proxies:
+                log.info(
+                    "Proxy %s: %d requests, %d failures, %.1f KiB/s, %d ejections",
+                    redact(proxy.url),
+                    proxy.requests,
+                    proxy.failures,
+                    (proxy.throughput or 0.0) / 1024,
+                    proxy.ejections,
+                )
@@ -0,0 +1,77 @@
+import logging
+import threading
+from collections.abc import Collection, Iterable
+from typing import Any
+
+log = logging.getLogger(__name__)
+
+
+class SpreadJoiner:
+    """
+    Pairs up the pages of each spread as they finish.
+
+    The first page of a spread to finish is held until the other one is in,
+    and whoever adds the last gets them all back to join. Spreads are so
+    joined by the download workers, in parallel, while the rest of the
+    gallery is still downloading.
+
+    Spreads sharing a page, like (1, 2) and (2, 3), make up one group that is
+    handed over once all of its pages are in, to be joined one after another
+    in the given order.
+    --------------------------
+    param: spreads -- list
+        (left, right) page index pairs
+    param: pages -- collection
+        Indexes of the pages of the gallery
+    """
+
+    def __init__(self, spreads: Iterable[tuple[str, str]], pages: Collection[str]):
+        self._groups: dict[str, list[tuple[str, str]]] = {}
+        order = list(spreads)
+        for left, right in order:
+            if left not in pages or right not in pages:
+                log.warning(
+                    "Requested to join non-existent pages (%s, %s), ignoring",
+                    left,
+                    right,
+                )
+                continue
+            # merge the groups of both pages, keeping the spreads in order
+            group = [(left, right)]
+            for other in (self._groups.get(left), self._groups.get(right)):
+                if other is not None and other[0] not in group:
+                    group = sorted(other + group, key=order.index)
+            for idx in {idx for spread in group for idx in spread}:
+                self._groups[idx] = group
+        for group in self.groups():
+            if len(group) > 1:
+                log.warning(
+                    "Spreads %s share pages, joining them one after another",
+                    ", ".join(f"({left}, {right})" for left, right in group),
+                )
+        self._halves: dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, idx: str) -> bool:
+        return idx in self._groups
+
+    def group(self, idx: str) -> list[tuple[str, str]]:
+        """The spreads of a page and of the pages it shares one with, in order."""
+        return self._groups[idx]
+
+    def groups(self) -> list[list[tuple[str, str]]]:
+        return list({id(group): group for group in self._groups.values()}.values())
+
+    def add(self, idx: str, half: Any) -> dict[str, Any] | None:
+        """
+        Hand over a finished page of a spread.
+        --------------------------
+        return: halves -- dict
+            The pages of its group by index once all are in, otherwise None
+        """
+        with self._lock:
+            self._halves[idx] = half
+            pages = {idx: None for spread in self._groups[idx] for idx in spread}
+            if any(idx not in self._halves for idx in pages):
+                return None
+            return {idx: self._halves.pop(idx) for idx in pages}
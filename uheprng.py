@@ -130,3 +130,64 @@ class UHEPRNG:
 
     def random(self):
         return self._random(2**1023 - 2) / (2**1023 - 1)
+
+
+def seeded_randoms(seed, count: int) -> list[float]:
+    """
+    Bulk equivalent of seeding a UHEPRNG and calling random() count times.
+
+    The mash hash and the multiply-with-carry generator are inlined over
+    local variables, and random() is computed directly in float space: the
+    big-integer scaling in UHEPRNG.random() always rounds back to the same
+    53-bit value, so the sequence is identical.
+    """
+    order = 48
+    seed = CONTROL_CHARACTERS_REGEX.sub("", str(seed).strip())
+
+    n = 0xEFC8249D
+
+    def mash(data: str) -> float:
+        nonlocal n
+        for c in data:
+            n += ord(c)
+            h = 0.02519603282416938 * n
+            n = int(h)
+            h -= n
+            h *= n
+            n = int(h)
+            h -= n
+            n += h * 0x100000000
+        return (n // 1) * 2.3283064365386963e-10
+
+    state = [mash(" ") for _ in range(order)]
+    mash(seed)
+
+    for c in seed:
+        code = str(ord(c))
+        for j in range(order):
+            s = state[j] - mash(code)
+            while s < 0:
+                s += 1
+            state[j] = s
+
+    carry = 1
+    phase = order
+    draws = [0.0] * count
+    for i in range(count):
+        phase += 1
+        if phase >= order:
+            phase = 0
+        t = 1768863 * state[phase] + carry * 2.3283064365386963e-10
+        carry = trunc(t)
+        high = state[phase] = t - carry
+
+        phase += 1
+        if phase >= order:
+            phase = 0
+        t = 1768863 * state[phase] + carry * 2.3283064365386963e-10
+        carry = trunc(t)
+        low = state[phase] = t - carry
+
+        draws[i] = high + trunc(low * 0x200000) * 1.1102230246251565e-16
+
+    return draws
@@ -0,0 +1,137 @@
+import logging
+import sqlite3
+import threading
+from time import time
+
+from utils import parse_url_line
+
+log = logging.getLogger(__name__)
+
+URL_STATES = ["queued", "in_progress", "done", "failed"]
+
+
+class UrlStore:
+    """
+    sqlite queue of gallery urls and what became of them.
+
+    Every url has a state (queued, in_progress, done or failed), the number
+    of attempts at it, the last error and when it was added and last
+    updated. Urls are looked up by primary key, so checking one costs the
+    same however long the history gets. Everything that is not done is
+    pending, in the order it was added, including galleries a crash left
+    in progress.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        log.debug(f"Opening url store {path}")
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS urls ("
+            "position INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "url TEXT NOT NULL UNIQUE, "
+            "state TEXT NOT NULL DEFAULT 'queued', "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "error TEXT, "
+            "added REAL NOT NULL, "
+            "updated REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS urls_state ON urls (state, position);"
+        )
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def import_urls(self, urls_file: str) -> int:
+        """Queue the gallery urls of a urls file, returns how many were new."""
+        now = time()
+        with open(urls_file, "r") as f:
+            urls = [(url, now, now) for url in map(parse_url_line, f) if url]
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO urls (url, added, updated) VALUES (?, ?, ?)",
+                urls,
+            )
+            self._db.commit()
+            return self._db.total_changes - before
+
+    def import_done(self, done_file: str) -> int:
+        """Mark the urls of a done file done, returns how many changed."""
+        now = time()
+        with open(done_file, "r") as f:
+            urls = [(url, now, now) for url in (line.strip() for line in f) if url]
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT INTO urls (url, state, added, updated) VALUES (?, 'done', ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET state = 'done', "
+                "updated = excluded.updated WHERE state != 'done'",
+                urls,
+            )
+            self._db.commit()
+            return self._db.total_changes - before
+
+    def export(self, path: str, state: str) -> int:
+        """Write the urls in a state to a text file, returns how many."""
+        with self._lock:
+            urls = self._db.execute(
+                "SELECT url FROM urls WHERE state = ? ORDER BY position", (state,)
+            ).fetchall()
+        with open(path, "w") as f:
+            for (url,) in urls:
+                f.write(f"{url}\n")
+        return len(urls)
+
+    def pending(self) -> list[str]:
+        with self._lock:
+            return [
+                url
+                for (url,) in self._db.execute(
+                    "SELECT url FROM urls WHERE state != 'done' ORDER BY position"
+                )
+            ]
+
+    def is_done(self, url: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM urls WHERE url = ? AND state = 'done'", (url,)
+            ).fetchone()
+        return row is not None
+
+    def _set_state(self, url: str, state: str, error: str | None, attempt: int):
+        now = time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO urls (url, state, attempts, error, added, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET state = excluded.state, "
+                "attempts = attempts + excluded.attempts, error = excluded.error, "
+                "updated = excluded.updated",
+                (url, state, attempt, error, now, now),
+            )
+            self._db.commit()
+
+    def start(self, url: str):
+        self._set_state(url, "in_progress", None, 1)
+
+    def done(self, url: str):
+        self._set_state(url, "done", None, 0)
+
+    def fail(self, url: str, error: str):
+        self._set_state(url, "failed", error, 0)
+
+    def counts(self) -> dict[str, int]:
+        with self._lock:
+            counts = dict(
+                self._db.execute("SELECT state, COUNT(*) FROM urls GROUP BY state")
+            )
+        return {state: counts.get(state, 0) for state in URL_STATES}
+
+    def log(self):
+        log.info(
+            "Url store: %s",
+            ", ".join(f"{count} {state}" for state, count in self.counts().items()),
+        )
@@ -1,13 +1,20 @@
+import json
 import logging
 import os
-import shutil
+import re
+import sqlite3
 import sys
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import Iterator, Mapping
 from math import floor
 from typing import TypeVar
+from urllib.parse import urlsplit
 
 from PIL import Image
 
-from uheprng import UHEPRNG
+from uheprng import seeded_randoms
 
 T = TypeVar("T")
 
@@ -15,6 +22,23 @@ T = TypeVar("T")
 log = logging.getLogger(__name__)
 
 
+def parse_url_line(line: str) -> str | None:
+    """Gallery url on a line of a urls file, None for comments and other urls."""
+    clean_line = line.replace("\n", "")
+    if "fakku.net/hentai/" not in clean_line:
+        return None
+    if clean_line.startswith("#"):
+        return None
+    elif "#" in clean_line:
+        clean_line = clean_line.split("#")[0]
+    return clean_line
+
+
+def url_chapter_id(url: str) -> str:
+    """Chapter id in a gallery url, https://www.fakku.net/hentai/{chapter_id}"""
+    return urlsplit(url).path.rstrip("/").split("/")[-1]
+
+
 def get_urls_list(urls_file, done_file):
     """
     Get list of urls from .txt file
@@ -34,16 +58,14 @@ def get_urls_list(urls_file, done_file):
     log.debug(f"Done: {len(done)}")
 
     urls: list[str] = []
+    seen: set[str] = set()
     with open(urls_file, "r") as f:
         for line in f:
-            clean_line = line.replace("\n", "")
-            if "fakku.net/hentai/" not in clean_line:
-                continue
-            if clean_line.startswith("#"):
+            clean_line = parse_url_line(line)
+            if clean_line is None:
                 continue
-            elif "#" in clean_line:
-                clean_line = clean_line.split("#")[0]
-            if clean_line not in done and clean_line not in urls:
+            if clean_line not in done and clean_line not in seen:
+                seen.add(clean_line)
                 urls.append(clean_line)
     log.debug(f"Urls: {len(urls)}")
     if len(urls) == 0:
@@ -77,14 +99,64 @@ def decode_xor_cipher(key: bytes | str, content: bytes) -> bytes:
     if isinstance(key, str):
         key = key.encode("utf-8")
 
-    key_length = len(key)
     content_length = len(content)
-    decoded = bytearray(content_length)
+    if content_length == 0:
+        return b""
+
+    # XOR everything at once as two big integers instead of byte by byte
+    repeats, rest = divmod(content_length, len(key))
+    stream = key * repeats + key[:rest]
+    decoded = int.from_bytes(content, "little") ^ int.from_bytes(stream, "little")
+
+    return decoded.to_bytes(content_length, "little")
+
+
+class LazyKeys(Mapping[str, list[int]]):
+    """
+    Page keys from decrypted key_data, each parsed only when it's looked up.
+
+    The data is scanned forward just far enough to find the requested page,
+    so the first pages can start downloading without waiting for the rest.
+    Lookups return a fresh list, since descrambling pops the seed off it.
+    """
+
+    PAGE_KEY_REGEX = re.compile(r'"([^"\\]*)"\s*:\s*(\[[^\[\]]*\])')
+
+    def __init__(self, data: str):
+        self._data = data
+        self._raw: dict[str, str] = {}
+        self._scanner: Iterator[re.Match] | None = self.PAGE_KEY_REGEX.finditer(data)
+        self._lock = threading.Lock()
+
+    def _scan(self, idx: str | None = None):
+        if self._scanner is None:
+            return
+
+        for match in self._scanner:
+            self._raw[match.group(1)] = match.group(2)
+            if match.group(1) == idx:
+                return
 
-    for i in range(content_length):
-        decoded[i] = content[i] ^ key[i % key_length]
+        self._scanner = None
+        if not self._raw and self._data.strip() not in ("", "{}", "[]"):
+            log.debug("Unexpected key data layout, parsing it all")
+            self._raw = {k: json.dumps(v) for k, v in json.loads(self._data).items()}
 
-    return bytes(decoded)
+    def __getitem__(self, idx: str) -> list[int]:
+        with self._lock:
+            if idx not in self._raw:
+                self._scan(idx)
+        return json.loads(self._raw[idx])
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            self._scan()
+        return iter(list(self._raw))
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._scan()
+        return len(self._raw)
 
 
 def calculate_decryption_key(key_hash: str, fakku_zid: str) -> str:
@@ -98,19 +170,118 @@ def calculate_decryption_key(key_hash: str, fakku_zid: str) -> str:
     return fakku_zid + key_hash + extra
 
 
-def randomize(ls: list[T], seed) -> list[T]:
-    instance = UHEPRNG()
-    instance.seed(seed)
+def _randomize(ls: list[T], seed) -> list[T]:
     copy = ls.copy()
 
     i = len(copy)
-    while i:
-        new_location = floor(instance.random() * i)
+    for draw in seeded_randoms(seed, i):
+        new_location = floor(draw * i)
         i -= 1
         copy[i], copy[new_location] = copy[new_location], copy[i]
     return copy
 
 
+class PermutationCache:
+    """
+    Memoizes the permutation randomize() applies for a (seed, length) pair.
+
+    Lookups go through an in-memory LRU first and then, if a path was given,
+    an sqlite store that survives between runs.
+    """
+
+    def __init__(self, maxsize: int = 4096, path: str | None = None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[tuple[str, int], tuple[int, ...]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+
+        if path is not None:
+            self.open(path)
+
+    def open(self, path: str):
+        log.debug(f"Opening permutation cache {path}")
+        self.close()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS permutations ("
+            "seed TEXT NOT NULL, length INTEGER NOT NULL, perm BLOB NOT NULL, "
+            "PRIMARY KEY (seed, length))"
+        )
+        self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get(self, seed, length: int) -> tuple[int, ...]:
+        key = (str(seed), length)
+
+        with self._lock:
+            perm = self._entries.get(key)
+            if perm is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return perm
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT perm FROM permutations WHERE seed = ? AND length = ?",
+                    key,
+                ).fetchone()
+                if row is not None:
+                    perm = tuple(array("I", row[0]))
+                    self.disk_hits += 1
+                    self._remember(key, perm)
+                    return perm
+
+        perm = tuple(_randomize(list(range(length)), seed))
+
+        with self._lock:
+            self.misses += 1
+            self._remember(key, perm)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR IGNORE INTO permutations VALUES (?, ?, ?)",
+                    (*key, array("I", perm).tobytes()),
+                )
+                self._db.commit()
+
+        return perm
+
+    def _remember(self, key: tuple[str, int], perm: tuple[int, ...]):
+        self._entries[key] = perm
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def add_stats(self, stats: Mapping[str, int]):
+        """Count lookups made by a copy of the cache in a worker process."""
+        with self._lock:
+            self.hits += stats["hits"]
+            self.disk_hits += stats["disk_hits"]
+            self.misses += stats["misses"]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+        }
+
+
+permutation_cache = PermutationCache()
+
+
+def randomize(ls: list[T], seed) -> list[T]:
+    return [ls[i] for i in permutation_cache.get(seed, len(ls))]
+
+
 def shuffle_array(ls: list[T], seed) -> list[T]:
     copy = ls.copy()
     for i, j in enumerate(randomize(list(range(len(ls))), seed)):
@@ -204,51 +375,3 @@ def many_to_one(data: list[str]) -> str | None:
         return data[0]
     else:
         return None
-
-
-def _make_cbzfile(
-    base_name, base_dir, verbose=0, dry_run=0, logger=None, owner=None, group=None
-):
-    """Create a cbz file from all the files under 'base_dir'.
-
-    The output cbz file will be named 'base_name' + ".cbz".  Returns the
-    name of the output cbz file.
-    """
-    import zipfile  # late import for breaking circular dependency
-
-    cbz_filename = base_name + ".cbz"
-    archive_dir = os.path.dirname(base_name)
-
-    if archive_dir and not os.path.exists(archive_dir):
-        if logger is not None:
-            logger.info("creating %s", archive_dir)
-        if not dry_run:
-            os.makedirs(archive_dir)
-
-    if logger is not None:
-        logger.info("creating '%s' and adding '%s' to it", cbz_filename, base_dir)
-
-    if not dry_run:
-        with zipfile.ZipFile(cbz_filename, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            path = os.path.normpath(base_dir)
-            if path != os.curdir:
-                zf.write(path, path)
-                if logger is not None:
-                    logger.info("adding '%s'", path)
-            for dirpath, dirnames, filenames in os.walk(base_dir):
-                for name in sorted(dirnames):
-                    path = os.path.normpath(os.path.join(dirpath, name))
-                    zf.write(path, path)
-                    if logger is not None:
-                        logger.info("adding '%s'", path)
-                for name in filenames:
-                    path = os.path.normpath(os.path.join(dirpath, name))
-                    if os.path.isfile(path):
-                        zf.write(path, path)
-                        if logger is not None:
-                            logger.info("adding '%s'", path)
-
-    return cbz_filename
-
-
-shutil.register_archive_format("cbz", _make_cbzfile, [], "CBZ file")